@@ -1,4 +1,4 @@
 from .singleton import Singleton
-from .pipeline import Pipeline
+from .pipeline import Pipeline, AsyncPipeline
 from .simple_exception import SimpleException
 from .socks_over_ssh import SocksOverSSH
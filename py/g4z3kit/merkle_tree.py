@@ -1,8 +1,30 @@
 #!/usr/bin/env python
 import hashlib
-import functools
+import mmap
+import socket
+import struct
+import threading
 import unittest
 import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+HASH_SIZE = 32
+
+# file header: magic, version, hash name, padding rule, digest size,
+# leaf count, blake2 person; the levels follow from the leaves up,
+# each contiguous
+FILE_MAGIC = b'G4MT'
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct('>4sB15sBHQ16sx')
+# an odd last node is hashed alone into the level above
+PAD_HASH_ALONE = 1
+# the same with Hasher domains: leaves, pairs and lone nodes prefixed
+PAD_DOMAINS = 2
 
 
 def get_hash(s):
@@ -11,41 +33,492 @@ def get_hash(s):
     return m.digest()
 
 
+class Hasher(object):
+    '''
+    node hash of a merkle tree. name is a hashlib algorithm, blake2b
+    and blake2s also take digest_size and person.
+    with domains, hashes of leaf data, of pairs and of nodes hashed
+    alone get distinct prefixes, so a promoted node can't be passed off
+    as a pair. without, nodes are the plain hash of the concatenated
+    children: Hasher() gives the same trees as get_hash.
+    '''
+    LEAF = b'\x00'
+    PAIR = b'\x01'
+    ALONE = b'\x02'
+
+    def __init__(self, name='sha256', digest_size=None, person=b'',
+                 domains=False):
+        if name not in hashlib.algorithms_guaranteed:
+            raise ValueError('unknown hash {n}'.format(n=name))
+        new = getattr(hashlib, name)
+        if not new().digest_size:
+            raise ValueError('variable length hash {n} is not supported'
+                             .format(n=name))
+        if digest_size == new().digest_size:
+            digest_size = None  # the default, as load() passes it
+        kwargs = {}
+        if digest_size is not None:
+            kwargs['digest_size'] = digest_size
+        if person:
+            kwargs['person'] = person
+        if kwargs and not name.startswith('blake2'):
+            raise ValueError('digest_size and person need blake2b/blake2s')
+        self.name = name
+        self.digest_size = digest_size
+        self.person = person
+        self.domains = domains
+        base = new(**kwargs)
+        self.size = base.digest_size
+        if not (kwargs or domains):
+            # the constructor is cheaper than copying a fresh object
+            def digest(data):
+                return new(data).digest()
+            self.leaf = self.pair = self.alone = digest
+            return
+        prefixes = [self.LEAF, self.PAIR, self.ALONE] if domains else \
+            [b'', b'', b'']
+        self.leaf, self.pair, self.alone = [
+            self._prefixed(base, x) for x in prefixes]
+
+    @staticmethod
+    def _prefixed(base, prefix):
+        '''
+        keyed objects are costly to create, copy one with the prefix fed
+        '''
+        start = base.copy()
+        start.update(prefix)
+        copy = start.copy
+
+        def digest(data):
+            m = copy()
+            m.update(data)
+            return m.digest()
+        return digest
+
+    def _params(self):
+        return (self.name, self.digest_size, self.person, self.domains)
+
+    def __reduce__(self):
+        return (Hasher, self._params())
+
+    def __eq__(self, other):
+        return isinstance(other, Hasher) and \
+            self._params() == other._params()
+
+    def __hash__(self):
+        return hash(self._params())
+
+    def __repr__(self):
+        return 'Hasher{p}'.format(p=self._params())
+
+
+DEFAULT_HASHER = Hasher()
+
+
+def pack_leaves(leaves, size=HASH_SIZE):
+    '''
+    pack size bytes leaves into one bytearray
+    '''
+    level = bytearray().join(leaves)
+    if len(level) != len(leaves) * size:
+        raise ValueError('leaves must be {n} bytes'.format(n=size))
+    return level
+
+
+def build_level(level, chunk=4096, hasher=DEFAULT_HASHER):
+    '''
+    hash each pair of nodes in level into the level above,
+    an odd last node is hashed alone.
+    digests are joined chunk pairs at a time to bound temporaries
+    '''
+    view = memoryview(level)
+    size = hasher.size
+    hash_pair = hasher.pair
+    n = len(level) // size
+    ret = bytearray(((n + 1) // 2) * size)
+    pair = 2 * size
+    end = (n // 2) * pair
+    for start in range(0, end, chunk * pair):
+        stop = min(end, start + chunk * pair)
+        ret[start // 2:stop // 2] = b''.join([
+            hash_pair(view[i:i + pair]) for i in range(start, stop, pair)
+        ])
+    if n % 2 == 1:
+        ret[-size:] = hasher.alone(view[-size:])
+    return ret
+
+
+def build_levels(level, count, hasher=DEFAULT_HASHER):
+    '''
+    return the count levels above level
+    '''
+    ret = []
+    for _ in range(count):
+        level = build_level(level, hasher=hasher)
+        ret.append(level)
+    return ret
+
+
+def build_parallel(level, workers, executor='process', min_chunk=1024,
+                   hasher=DEFAULT_HASHER):
+    '''
+    return the levels above level up to the root, hashing subtrees
+    of a power of two leaves in a pool of workers.
+    subtrees are aligned to their size, so within them every level has
+    an even number of nodes except at the end of the last one, which is
+    the end of the whole level: the odd node rule gives the same nodes
+    as a serial build. the levels above the subtree roots are built
+    serially.
+    '''
+    n = len(level) // hasher.size
+    chunk = 1 << (max(min_chunk, 2) - 1).bit_length()
+    while chunk * workers * 4 < n:
+        chunk *= 2
+    if n <= chunk:
+        return build_levels(level, height_of(n) - 1, hasher)
+    count = chunk.bit_length() - 1
+    step = chunk * hasher.size
+    parts = [bytes(level[i:i + step]) for i in range(0, len(level), step)]
+    pool = ProcessPoolExecutor if executor == 'process' else \
+        ThreadPoolExecutor
+    with pool(workers) as p:
+        subtrees = list(p.map(build_levels, parts, [count] * len(parts),
+                              [hasher] * len(parts)))
+    ret = [bytearray().join(x) for x in zip(*subtrees)]
+    del subtrees
+    while len(ret[-1]) > hasher.size:
+        ret.append(build_level(ret[-1], hasher=hasher))
+    return ret
+
+
+def height_of(n):
+    '''
+    height of a tree over n leaves
+    '''
+    height = 1
+    while n > 1:
+        n = (n + 1) // 2
+        height += 1
+    return height
+
+
 class MerkleTree:
-    def __init__(self, leaves):
-        def _build_merkle_level(leaves):
-            pairs = [x for x in zip(
-                leaves[0::2],
-                leaves[1::2]
-            )]
-            if len(leaves) % 2 == 1:
-                pairs.append((leaves[-1], ''))
-            nodes = [x for x in map(
-                lambda x: get_hash(x[0] + x[1]),
-                pairs
-            )]
-            return nodes
-
-        # build a BINARY merkle tree from leaves
-        # also return path for each leave
-        def _build_merkle_tree(leaves):
-            levels = []
-            l = leaves
-            levels.insert(0, l)
-            while len(l) > 1:
-                l = _build_merkle_level(l)
-                levels.insert(0, l)
-            return levels
-        self._levels = _build_merkle_tree(leaves)
+    '''
+    a BINARY merkle tree over hasher.size bytes leaves.
+    each level is one contiguous bytearray of n * hasher.size bytes,
+    stored from the leaves up; depth in root()/get() counts from
+    the root as before.
+    with workers > 1 the tree is built by build_parallel in a
+    'process' or 'thread' pool.
+    leaves can be changed with update()/update_many() and added with
+    append()/extend(), rehashing only the nodes above them.
+    proof()/multiproof() return audit paths for verify()/verify_many().
+    save() writes the tree to a file that load() maps back without
+    reading it; updates to a mapped tree are written in place.
+    nodes are hashed by hasher, a Hasher, sha256 by default.
+    '''
+    def __init__(self, leaves, workers=None, executor='process',
+                 hasher=DEFAULT_HASHER):
+        self.hasher = hasher
+        self._size = hasher.size
+        self._mmap = None
+        self._levels = [pack_leaves(leaves, self._size)]
+        if workers is not None and workers > 1:
+            self._levels += build_parallel(self._levels[0], workers,
+                                           executor, hasher=hasher)
+        while len(self._levels[-1]) > self._size:
+            self._levels.append(
+                build_level(self._levels[-1], hasher=hasher))
+
+    def _level(self, depth):
+        if not 0 <= depth < len(self._levels):
+            raise IndexError('node depth out of range')
+        return self._levels[len(self._levels) - 1 - depth]
 
     def root(self):
-        return self._levels[0][0]
+        return self.get(0, 0)
 
     def height(self):
         return len(self._levels)
 
+    def width(self, depth):
+        return len(self._level(depth)) // self._size
+
+    def size(self):
+        return len(self._levels[0]) // self._size
+
     def get(self, depth, idx):
-        return self._levels[depth][idx]
+        level = self._level(depth)
+        n = len(level) // self._size
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError('node index out of range')
+        return bytes(level[idx * self._size:(idx + 1) * self._size])
+
+    def save(self, path):
+        '''
+        write the tree to path, replacing it atomically
+        '''
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            hasher = self.hasher
+            f.write(FILE_HEADER.pack(
+                FILE_MAGIC, FILE_VERSION, hasher.name.encode(),
+                PAD_DOMAINS if hasher.domains else PAD_HASH_ALONE,
+                hasher.size, self.size(), hasher.person))
+            for level in self._levels:
+                f.write(level)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, writable=False):
+        '''
+        map a tree written by save(); with writable, update() and
+        update_many() change the file in place, flush() syncs it
+        '''
+        with open(path, 'r+b' if writable else 'rb') as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) != FILE_HEADER.size:
+                raise ValueError('truncated merkle tree file')
+            magic, version, name, pad, digest_size, n, person = \
+                FILE_HEADER.unpack(header)
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                raise ValueError('not a merkle tree file')
+            if pad not in (PAD_HASH_ALONE, PAD_DOMAINS):
+                raise ValueError('unsupported merkle tree file')
+            name = name.rstrip(b'\x00').decode()
+            person = person.rstrip(b'\x00')
+            hasher = Hasher(name, person=person, domains=pad == PAD_DOMAINS,
+                            digest_size=digest_size
+                            if name.startswith('blake2') else None)
+            if hasher.size != digest_size:
+                raise ValueError('unsupported merkle tree file')
+            widths = [n]
+            while widths[-1] > 1:
+                widths.append((widths[-1] + 1) // 2)
+            end = FILE_HEADER.size + sum(widths) * digest_size
+            if n == 0 or os.fstat(f.fileno()).st_size != end:
+                raise ValueError('truncated merkle tree file')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE
+                          if writable else mmap.ACCESS_READ)
+        mtree = cls.__new__(cls)
+        mtree.hasher = hasher
+        mtree._size = digest_size
+        mtree._mmap = m
+        mtree._writable = writable
+        view = memoryview(m)
+        mtree._levels = []
+        start = FILE_HEADER.size
+        for width in widths:
+            stop = start + width * digest_size
+            mtree._levels.append(view[start:stop])
+            start = stop
+        view.release()
+        return mtree
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        '''
+        unmap a loaded tree
+        '''
+        if self._mmap is None:
+            return
+        for level in self._levels:
+            level.release()
+        self._levels = []
+        self._mmap.close()
+        self._mmap = None
+
+    def _node(self, lvl, idx):
+        return bytes(
+            self._levels[lvl][idx * self._size:(idx + 1) * self._size])
+
+    def proof(self, idx):
+        '''
+        siblings of leaf idx and its ancestors from the leaves up,
+        None where the node is an odd last node hashed alone
+        '''
+        n = self.size()
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError('leaf index out of range')
+        ret = []
+        for lvl in range(len(self._levels) - 1):
+            sibling = idx ^ 1
+            if sibling < len(self._levels[lvl]) // self._size:
+                ret.append(self._node(lvl, sibling))
+            else:
+                ret.append(None)
+            idx = get_parent(idx)
+        return ret
+
+    def multiproof(self, indices):
+        '''
+        the siblings needed to verify the leaves at indices together,
+        level by level from the leaves up in index order. siblings that
+        are themselves leaves of the set or ancestors of them are left
+        out, so shared paths are sent once.
+        '''
+        n = self.size()
+        nodes = set()
+        for idx in indices:
+            if not 0 <= idx < n:
+                raise IndexError('leaf index out of range')
+            nodes.add(idx)
+        ret = []
+        for lvl in range(len(self._levels) - 1):
+            width = len(self._levels[lvl]) // self._size
+            for idx in sorted(nodes):
+                sibling = idx ^ 1
+                if sibling < width and sibling not in nodes:
+                    ret.append(self._node(lvl, sibling))
+            nodes = {get_parent(x) for x in nodes}
+        return ret
+
+    def _hash_up(self, lvl, idx):
+        '''
+        rehash node idx of the level above level lvl (from the leaves)
+        '''
+        level = self._levels[lvl]
+        start = 2 * idx * self._size
+        stop = min(start + 2 * self._size, len(level))
+        hash_node = self.hasher.pair if stop - start > self._size else \
+            self.hasher.alone
+        self._levels[lvl + 1][idx * self._size:(idx + 1) * self._size] = \
+            hash_node(memoryview(level)[start:stop])
+
+    def update(self, idx, leaf):
+        self.update_many([(idx, leaf)])
+
+    def update_many(self, updates):
+        '''
+        set leaves from a dict or (idx, leaf) pairs, then rehash their
+        ancestors level by level, each shared ancestor once
+        '''
+        if self._mmap is not None and not self._writable:
+            raise ValueError('merkle tree is mapped read only')
+        if hasattr(updates, 'items'):
+            updates = updates.items()
+        leaves = self._levels[0]
+        n = len(leaves) // self._size
+        dirty = set()
+        for idx, leaf in updates:
+            if idx < 0:
+                idx += n
+            if not 0 <= idx < n:
+                raise IndexError('leaf index out of range')
+            if len(leaf) != self._size:
+                raise ValueError(
+                    'leaves must be {n} bytes'.format(n=self._size))
+            leaves[idx * self._size:(idx + 1) * self._size] = leaf
+            dirty.add(idx)
+        for lvl in range(len(self._levels) - 1):
+            dirty = {get_parent(x) for x in dirty}
+            for idx in dirty:
+                self._hash_up(lvl, idx)
+
+    def append(self, leaf):
+        self.extend([leaf])
+
+    def extend(self, leaves):
+        '''
+        add leaves at the end. the new nodes of each level run to its
+        end, so the level above is rebuilt from the parent of the first
+        one; this also rehashes an odd last node that gets a sibling.
+        a new root level is added when the old root gets one.
+        '''
+        if self._mmap is not None:
+            raise ValueError('cannot append to a mapped merkle tree')
+        added = pack_leaves(leaves, self._size)
+        if not added:
+            return
+        first = len(self._levels[0]) // self._size
+        self._levels[0] += added
+        lvl = 0
+        while len(self._levels[lvl]) > self._size:
+            if lvl + 1 == len(self._levels):
+                self._levels.append(bytearray())
+            first = get_parent(first)
+            start = 2 * first * self._size
+            up = self._levels[lvl + 1]
+            del up[first * self._size:]
+            up += build_level(memoryview(self._levels[lvl])[start:],
+                              hasher=self.hasher)
+            lvl += 1
+
+
+class MerkleStream(object):
+    '''
+    root of a MerkleTree fed one leaf at a time. only the pending
+    node of each level is kept: a stack of (level, hash) from the
+    highest level down, like the binary digits of the leaf count.
+    '''
+    def __init__(self, hasher=DEFAULT_HASHER):
+        self.hasher = hasher
+        self._stack = []
+        self.count = 0
+
+    def push(self, leaf):
+        if len(leaf) != self.hasher.size:
+            raise ValueError(
+                'leaves must be {n} bytes'.format(n=self.hasher.size))
+        lvl, node = 0, bytes(leaf)
+        while self._stack and self._stack[-1][0] == lvl:
+            node = self.hasher.pair(self._stack.pop()[1] + node)
+            lvl += 1
+        self._stack.append((lvl, node))
+        self.count += 1
+
+    def extend(self, leaves):
+        for leaf in leaves:
+            self.push(leaf)
+        return self
+
+    def root(self):
+        '''
+        the pending nodes are the last of their levels and the lowest
+        one is odd, so it is hashed alone up to the next pending node,
+        merged with it and so on to the top
+        '''
+        if not self._stack:
+            raise ValueError('no leaves')
+        lvl, node = self._stack[-1]
+        for up, left in reversed(self._stack[:-1]):
+            while lvl < up:
+                node = self.hasher.alone(node)
+                lvl += 1
+            node = self.hasher.pair(left + node)
+            lvl += 1
+        return node
+
+
+def stream_root(leaves, hasher=DEFAULT_HASHER):
+    return MerkleStream(hasher).extend(leaves).root()
+
+
+def file_leaves(path, block_size=1 << 20, hasher=DEFAULT_HASHER):
+    '''
+    hash the file at path in block_size blocks through mmap
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                for start in range(0, len(m), block_size):
+                    yield hasher.leaf(view[start:start + block_size])
+            finally:
+                view.release()
+
+
+def file_root(path, block_size=1 << 20, hasher=DEFAULT_HASHER):
+    return stream_root(file_leaves(path, block_size, hasher), hasher)
 
 
 def get_children(idx):
@@ -56,26 +529,239 @@ def get_parent(idx):
     return idx // 2
 
 
-# check leaves for errors
-def check(leaves, mtree):
-    my_mtree = MerkleTree(leaves)
-    if my_mtree.root() == mtree.root():
+def verify(leaf, idx, proof, root, hasher=DEFAULT_HASHER):
+    '''
+    check leaf is at idx under root given proof(idx)
+    '''
+    node = leaf
+    for sibling in proof:
+        if sibling is None:
+            if idx % 2 == 1:
+                return False
+            node = hasher.alone(node)
+        elif idx % 2 == 0:
+            node = hasher.pair(node + sibling)
+        else:
+            node = hasher.pair(sibling + node)
+        idx = get_parent(idx)
+    return idx == 0 and node == root
+
+
+def verify_many(leaves, n, proof, root, hasher=DEFAULT_HASHER):
+    '''
+    check a dict {idx: leaf} is in a tree of n leaves under root
+    given multiproof() of its indices
+    '''
+    if not leaves or any(not 0 <= x < n for x in leaves):
+        return False
+    siblings = iter(proof)
+    nodes = dict(leaves)
+    width = n
+    while width > 1:
+        parents = {}
+        for idx in sorted(nodes):
+            parent = get_parent(idx)
+            if parent in parents:
+                continue
+            sibling = idx ^ 1
+            if sibling >= width:
+                parents[parent] = hasher.alone(nodes[idx])
+                continue
+            other = nodes.get(sibling)
+            if other is None:
+                other = next(siblings, None)
+                if other is None:
+                    return False
+            if idx % 2 == 0:
+                parents[parent] = hasher.pair(nodes[idx] + other)
+            else:
+                parents[parent] = hasher.pair(other + nodes[idx])
+        nodes = parents
+        width = (width + 1) // 2
+    return next(siblings, None) is None and nodes[0] == root
+
+
+class MerkleDiffServer(object):
+    '''
+    answer diff requests about mtree:
+    ('info',) -> (leaf count, height, digest size)
+    ('nodes', [(depth, idx), ...]) -> [hash or None if out of range]
+    '''
+    def __init__(self, mtree):
+        self.mtree = mtree
+
+    def handle(self, request):
+        if request[0] == 'info':
+            return (self.mtree.size(), self.mtree.height(),
+                    self.mtree.hasher.size)
+        if request[0] == 'nodes':
+            ret = []
+            for depth, idx in request[1]:
+                try:
+                    ret.append(self.mtree.get(depth, idx))
+                except IndexError:
+                    ret.append(None)
+            return ret
+        raise ValueError('unknown request {r}'.format(r=request[0]))
+
+
+class LocalTransport(object):
+    '''
+    loopback transport calling a MerkleDiffServer directly,
+    counting the hashes fetched
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.fetched = 0
+
+    def request(self, request):
+        response = self.server.handle(request)
+        if request[0] == 'nodes':
+            self.fetched += len(response)
+        return response
+
+
+def encode_request(request):
+    if request[0] == 'info':
+        return b'I'
+    return b'N' + b''.join(struct.pack('>IQ', d, i) for d, i in request[1])
+
+
+def decode_request(data):
+    if data[:1] == b'I':
+        return ('info',)
+    if data[:1] == b'N':
+        return ('nodes', list(struct.iter_unpack('>IQ', data[1:])))
+    raise ValueError('bad request')
+
+
+def encode_response(request, response, size):
+    if request[0] == 'info':
+        return struct.pack('>QIH', *response)
+    return b''.join(b'\x00' * (size + 1) if x is None else b'\x01' + x
+                    for x in response)
+
+
+def decode_response(request, data, size):
+    if request[0] == 'info':
+        return struct.unpack('>QIH', data)
+    size += 1
+    return [data[i + 1:i + size] if data[i:i + 1] == b'\x01' else None
+            for i in range(0, len(data), size)]
+
+
+def send_frame(sock, data):
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def recv_frame(sock):
+    '''
+    read one length prefixed frame, None on a clean EOF
+    '''
+    head = recv_exact(sock, 4)
+    if head is None:
         return None
-    if my_mtree.height() != mtree.height():
-        return [x for x in range(len(leaves))]
-    mismatches = [0]
-    for depth in range(1, my_mtree.height()):
-        tests = functools.reduce(
-            lambda x, y: x + y,
-            [get_children(x) for x in mismatches]
-        )
-        mismatches = []
-        for t in tests:
-            mine = my_mtree.get(depth, t)
-            theirs = mtree.get(depth, t)
-            if mine != theirs:
-                mismatches.append(t)
-    return mismatches
+    data = recv_exact(sock, struct.unpack('>I', head)[0])
+    if data is None:
+        raise EOFError('connection closed inside a frame')
+    return data
+
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        data = sock.recv(n - len(buf))
+        if not data:
+            if buf:
+                raise EOFError('connection closed inside a frame')
+            return None
+        buf += data
+    return bytes(buf)
+
+
+def serve_diff(sock, server):
+    '''
+    answer framed requests on sock with server until EOF
+    '''
+    try:
+        while True:
+            data = recv_frame(sock)
+            if data is None:
+                break
+            request = decode_request(data)
+            send_frame(sock, encode_response(
+                request, server.handle(request), server.mtree.hasher.size))
+    finally:
+        sock.close()
+
+
+class SocketTransport(object):
+    '''
+    send requests as length prefixed frames to serve_diff() on sock
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.fetched = 0
+        self.size = None
+
+    def request(self, request):
+        send_frame(self.sock, encode_request(request))
+        data = recv_frame(self.sock)
+        if data is None:
+            raise EOFError('diff server closed the connection')
+        response = decode_response(request, data, self.size)
+        if request[0] == 'info':
+            self.size = response[2]
+        elif request[0] == 'nodes':
+            self.fetched += len(response)
+        return response
+
+    def close(self):
+        self.sock.close()
+
+
+def diff(mtree, transport):
+    '''
+    indices of the leaves that differ between mtree and the remote
+    tree, one round trip per level.
+    nodes are walked by level from the leaves up, so trees of
+    different sizes line up: a node is compared only if it covers
+    the same leaves in both trees, nodes across the end of the shorter
+    tree are always descended, and the leaves only one tree has all
+    differ.
+    '''
+    n, height, size = transport.request(('info',))
+    if size != mtree.hasher.size:
+        raise ValueError('trees have different digest sizes')
+    mine = mtree.size()
+    m = min(n, mine)
+    extra = list(range(m, max(n, mine)))
+    if m == 0:
+        return extra
+    lvl = height_of(m) - 1
+    nodes = [0]
+    while True:
+        span = 1 << lvl
+        same = [x for x in nodes if n == mine or (x + 1) * span <= m]
+        theirs = transport.request(
+            ('nodes', [(height - 1 - lvl, x) for x in same]))
+        differ = set(nodes).difference(same)
+        for idx, node in zip(same, theirs):
+            if node != mtree._node(lvl, idx):
+                differ.add(idx)
+        if lvl == 0:
+            return sorted(differ) + extra
+        lvl -= 1
+        limit = (m + (1 << lvl) - 1) >> lvl
+        nodes = [c for x in sorted(differ) for c in get_children(x)
+                 if c < limit]
+
+
+# check leaves for errors
+def check(leaves, mtree, hasher=None):
+    mismatches = diff(MerkleTree(leaves, hasher=hasher or mtree.hasher),
+                      LocalTransport(MerkleDiffServer(mtree)))
+    return mismatches or None
 
 
 class TestMerkleTree(unittest.TestCase):
@@ -110,6 +796,291 @@ class TestMerkleTree(unittest.TestCase):
             print(mismatches)
             self.assertEqual(mod_idx, mismatches)
 
+    def test_levels(self):
+        for n in range(1, 18):
+            leaves = self.get_leaves(n)
+            mtree = MerkleTree(leaves)
+            levels = [leaves]
+            while len(levels[0]) > 1:
+                l = levels[0]
+                up = [get_hash(l[i] + l[i + 1])
+                      for i in range(0, len(l) - 1, 2)]
+                if len(l) % 2 == 1:
+                    up.append(get_hash(l[-1]))
+                levels.insert(0, up)
+            self.assertEqual(len(levels), mtree.height())
+            self.assertEqual(levels[0][0], mtree.root())
+            for depth, level in enumerate(levels):
+                self.assertEqual(len(level), mtree.width(depth))
+                for idx, node in enumerate(level):
+                    self.assertEqual(node, mtree.get(depth, idx))
+
+    def test_parallel(self):
+        for n in [1, 2, 3, 7, 8, 9, 31, 33, 100]:
+            leaf_level = pack_leaves(self.get_leaves(n))
+            serial = build_levels(leaf_level, height_of(n) - 1)
+            for min_chunk in [1, 2, 3, 4, 5]:
+                self.assertEqual(
+                    serial,
+                    build_parallel(leaf_level, 3, 'thread', min_chunk))
+        leaves = self.get_leaves(5000)
+        self.assertEqual(MerkleTree(leaves).root(),
+                         MerkleTree(leaves, workers=2).root())
+
+    def test_update(self):
+        for n in [1, 2, 3, 5, 8, 13, 64, 100]:
+            leaves = self.get_leaves(n)
+            mtree = MerkleTree(leaves)
+            for k in [1, 2, 5]:
+                indices = set(random.randrange(n) for x in range(k))
+                leaves = self.mod(leaves, indices)
+                mtree.update_many({x: leaves[x] for x in indices})
+                self.assertEqual(MerkleTree(leaves)._levels, mtree._levels)
+            leaves[-1] = self.get_mock_hash()
+            mtree.update(-1, leaves[-1])
+            self.assertEqual(MerkleTree(leaves)._levels, mtree._levels)
+        self.assertRaises(IndexError, mtree.update, n, leaves[0])
+        self.assertRaises(ValueError, mtree.update, 0, b'short')
+
+    def test_append(self):
+        leaves = self.get_leaves(1)
+        mtree = MerkleTree(leaves)
+        for n in range(40):
+            leaves.append(self.get_mock_hash())
+            mtree.append(leaves[-1])
+            self.assertEqual(MerkleTree(leaves)._levels, mtree._levels)
+        for k in [0, 1, 3, 7, 24, 100]:
+            more = self.get_leaves(k)
+            leaves += more
+            mtree.extend(more)
+            self.assertEqual(MerkleTree(leaves)._levels, mtree._levels)
+
+    def test_proof(self):
+        for n in [1, 2, 3, 5, 8, 13, 33]:
+            leaves = self.get_leaves(n)
+            mtree = MerkleTree(leaves)
+            root = mtree.root()
+            for idx in range(n):
+                proof = mtree.proof(idx)
+                self.assertEqual(mtree.height() - 1, len(proof))
+                self.assertTrue(verify(leaves[idx], idx, proof, root))
+                self.assertFalse(
+                    verify(self.get_mock_hash(), idx, proof, root))
+                if n > 1:
+                    self.assertFalse(
+                        verify(leaves[idx], idx ^ 1, proof, root))
+        self.assertRaises(IndexError, mtree.proof, n)
+
+    def test_multiproof(self):
+        for n in [1, 2, 3, 5, 8, 13, 33, 100]:
+            leaves = self.get_leaves(n)
+            mtree = MerkleTree(leaves)
+            root = mtree.root()
+            for k in [1, 2, 3, 10]:
+                indices = set(random.randrange(n) for x in range(k))
+                proof = mtree.multiproof(indices)
+                self.assertLessEqual(
+                    len(proof), len(indices) * (mtree.height() - 1))
+                subset = {x: leaves[x] for x in indices}
+                self.assertTrue(verify_many(subset, n, proof, root))
+                self.assertFalse(verify_many(subset, n, proof + [root], root))
+                if proof:
+                    self.assertFalse(verify_many(subset, n, proof[1:], root))
+                subset[min(indices)] = self.get_mock_hash()
+                self.assertFalse(verify_many(subset, n, proof, root))
+        proof = mtree.multiproof(range(n))
+        self.assertEqual([], proof)
+        self.assertTrue(verify_many(dict(enumerate(leaves)), n, proof, root))
+
+    def test_stream(self):
+        for n in range(1, 40):
+            leaves = self.get_leaves(n)
+            stream = MerkleStream()
+            for leaf in leaves[:n // 2]:
+                stream.push(leaf)
+            if stream.count:
+                stream.root()
+            stream.extend(leaves[n // 2:])
+            self.assertEqual(n, stream.count)
+            self.assertLessEqual(len(stream._stack), n.bit_length())
+            self.assertEqual(MerkleTree(leaves).root(), stream.root())
+        self.assertRaises(ValueError, MerkleStream().root)
+
+    def test_file_root(self):
+        data = os.urandom(10000)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            for block_size in [1000, 1024, 4096, 20000]:
+                leaves = [get_hash(data[i:i + block_size])
+                          for i in range(0, len(data), block_size)]
+                self.assertEqual(leaves, list(file_leaves(f.name, block_size)))
+                self.assertEqual(MerkleTree(leaves).root(),
+                                 file_root(f.name, block_size))
+
+    def test_diff(self):
+        leaves = self.get_leaves(100)
+        theirs = MerkleTree(leaves)
+        transport = LocalTransport(MerkleDiffServer(theirs))
+        self.assertEqual([], diff(MerkleTree(leaves), transport))
+        self.assertEqual(1, transport.fetched)
+        for n in [1, 2, 50, 63, 64, 65, 99, 100, 101, 150]:
+            for k in [0, 1, 3]:
+                mine = self.get_leaves(n - len(leaves)) if n > 100 else []
+                mine = leaves[:n] + mine
+                indices = set(random.randrange(n) for x in range(k))
+                mine = self.mod(mine, indices)
+                expect = sorted(set(indices) | set(range(min(n, 100),
+                                                         max(n, 100))))
+                transport = LocalTransport(MerkleDiffServer(theirs))
+                self.assertEqual(expect, diff(MerkleTree(mine), transport))
+        self.assertIsNone(check(leaves, theirs))
+        mtree = MerkleTree(leaves[:8])
+        server = MerkleDiffServer(mtree)
+        self.assertEqual(4, server.handle(('info',))[1])
+        self.assertEqual(
+            [mtree.get(3, 0), None, None, None, None],
+            server.handle(('nodes', [(3, 0), (4, 0), (5, 0), (6, 0),
+                                     (-1, 0)])))
+        self.assertRaises(IndexError, theirs.get, 10, 0)
+
+    def test_diff_socket(self):
+        leaves = self.get_leaves(1000)
+        mine = self.mod(leaves, [3, 500, 999])
+        a, b = socket.socketpair()
+        t = threading.Thread(
+            target=serve_diff, args=(b, MerkleDiffServer(MerkleTree(leaves))))
+        t.start()
+        transport = SocketTransport(a)
+        self.assertEqual([3, 500, 999], diff(MerkleTree(mine), transport))
+        self.assertLessEqual(transport.fetched,
+                             3 * 2 * MerkleTree(mine).height())
+        self.assertEqual([], diff(MerkleTree(leaves), transport))
+        self.assertEqual(list(range(900, 1000)),
+                         diff(MerkleTree(leaves[:900]), transport))
+        transport.close()
+        t.join()
+
+    def test_file(self):
+        leaves = self.get_leaves(37)
+        mtree = MerkleTree(leaves)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'tree')
+            mtree.save(path)
+            mapped = MerkleTree.load(path)
+            self.assertEqual(mtree.root(), mapped.root())
+            self.assertEqual(mtree.height(), mapped.height())
+            self.assertEqual(mtree.proof(5), mapped.proof(5))
+            self.assertRaises(ValueError, mapped.update, 0, leaves[0])
+            mapped.close()
+            mapped = MerkleTree.load(path, writable=True)
+            leaves = self.mod(leaves, [0, 20, 36])
+            mapped.update_many({x: leaves[x] for x in [0, 20, 36]})
+            self.assertRaises(ValueError, mapped.append, leaves[0])
+            mapped.flush()
+            mapped.close()
+            mapped = MerkleTree.load(path)
+            self.assertEqual(MerkleTree(leaves)._levels,
+                             [bytearray(x) for x in mapped._levels])
+            mapped.close()
+            with open(path, 'r+b') as f:
+                f.write(b'XXXX')
+            self.assertRaises(ValueError, MerkleTree.load, path)
+
+    def test_hasher(self):
+        legacy = self.get_leaves(9)
+        self.assertEqual(MerkleTree(legacy).root(),
+                         MerkleTree(legacy, hasher=Hasher()).root())
+        self.assertEqual(get_hash(legacy[0] + legacy[1]),
+                         MerkleTree(legacy[:2]).root())
+        hashers = [
+            Hasher('sha256', domains=True),
+            Hasher('blake2b'),
+            Hasher('blake2b', digest_size=32, person=b'g4z3'),
+            Hasher('blake2s', digest_size=16, domains=True),
+            Hasher('blake2b', digest_size=24, person=b'g4z3', domains=True),
+        ]
+        roots = set()
+        for hasher in hashers:
+            leaves = [hasher.leaf(x) for x in legacy]
+            mtree = MerkleTree(leaves, hasher=hasher)
+            roots.add(mtree.root())
+            self.assertEqual(hasher.size, len(mtree.root()))
+            self.assertEqual(stream_root(leaves, hasher), mtree.root())
+            packed = pack_leaves(leaves, hasher.size)
+            self.assertEqual(mtree._levels, [packed] + build_parallel(
+                packed, 2, 'process', 2, hasher))
+            self.assertTrue(verify(leaves[8], 8, mtree.proof(8),
+                                   mtree.root(), hasher))
+            self.assertFalse(verify(leaves[8], 8, mtree.proof(8),
+                                    mtree.root()))
+            self.assertTrue(verify_many({1: leaves[1], 8: leaves[8]}, 9,
+                                        mtree.multiproof([1, 8]),
+                                        mtree.root(), hasher))
+            mods = self.mod(legacy, [2, 7])
+            self.assertEqual([2, 7], check([hasher.leaf(x) for x in mods],
+                                           mtree))
+            with tempfile.TemporaryDirectory() as d:
+                path = os.path.join(d, 'tree')
+                mtree.save(path)
+                mapped = MerkleTree.load(path, writable=True)
+                self.assertEqual(hasher, mapped.hasher)
+                mapped.update(3, leaves[0])
+                mtree.update(3, leaves[0])
+                self.assertEqual(mtree.root(), mapped.root())
+                mapped.close()
+        self.assertEqual(len(hashers), len(roots))
+        self.assertEqual(Hasher('blake2b'), Hasher('blake2b', digest_size=64))
+        self.assertRaises(ValueError, Hasher, 'sha256', digest_size=16)
+        self.assertRaises(ValueError, Hasher, 'nope')
+        self.assertRaises(ValueError, Hasher, 'shake_128')
+
+    def test_domains(self):
+        # without domains two inner nodes hashed as leaf data make a
+        # one leaf tree with the same root
+        for hasher, same in [(Hasher(), True),
+                             (Hasher('sha256', domains=True), False)]:
+            leaves = [hasher.leaf(x) for x in self.get_leaves(3)]
+            mtree = MerkleTree(leaves, hasher=hasher)
+            forged = [hasher.leaf(mtree.get(1, 0) + mtree.get(1, 1))]
+            self.assertEqual(
+                same, MerkleTree(forged, hasher=hasher).root() == mtree.root())
+
+
+def bench_parallel(n=1 << 21, workers=(1, 2, 4, 8)):
+    leaves = [os.urandom(HASH_SIZE) for x in range(n)]
+    base = None
+    for w in workers:
+        start = time.perf_counter()
+        MerkleTree(leaves, workers=w)
+        cost = time.perf_counter() - start
+        base = base or cost
+        print('{n} leaves, {w} workers: {c:.3f}s, speedup {s:.2f}'.format(
+            n=n, w=w, c=cost, s=base / cost))
+
+
+def bench_hashers(n=1 << 20):
+    hashers = [
+        ('sha256', Hasher()),
+        ('sha256 domains', Hasher('sha256', domains=True)),
+        ('blake2b-256', Hasher('blake2b', digest_size=32)),
+        ('blake2b-256 person domains',
+         Hasher('blake2b', digest_size=32, person=b'g4z3', domains=True)),
+        ('blake2s-256', Hasher('blake2s')),
+        ('blake2s-128', Hasher('blake2s', digest_size=16)),
+    ]
+    for label, hasher in hashers:
+        leaves = [os.urandom(hasher.size) for x in range(n)]
+        start = time.perf_counter()
+        MerkleTree(leaves, hasher=hasher)
+        print('{n} leaves, {h}: {c:.3f}s'.format(
+            n=n, h=label, c=time.perf_counter() - start))
+
 
 if __name__ == "__main__":
-    unittest.main()
+    if sys.argv[1:2] == ['bench']:
+        print('cpu count {c}'.format(c=os.cpu_count()))
+        bench_parallel()
+        bench_hashers()
+    else:
+        unittest.main()
@@ -1,28 +1,612 @@
+import asyncio
+import collections
+import functools
+import inspect
+import itertools
+import math
+import queue
+import sys
+import threading
+import time
 import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    FIRST_COMPLETED, wait
+
+
+def percentile(values, q):
+    '''
+    nearest rank percentile, None for no values
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class StageStats(object):
+    '''
+    calls, items and latency of one stage function. latency
+    percentiles are over the last samples calls
+    '''
+
+    def __init__(self, name, samples=1024):
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self.total_ns = 0
+        self.first = None
+        self.last = None
+        self._samples = collections.deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def record(self, start, ns, items=1):
+        with self._lock:
+            self.calls += 1
+            self.items += items
+            self.total_ns += ns
+            if self.first is None:
+                self.first = start
+            self.last = start + ns
+            self._samples.append(ns)
+
+    def summary(self):
+        with self._lock:
+            samples = list(self._samples)
+            wall = (self.last - self.first) / 1e9 if self.calls else 0
+            return {
+                'name': self.name,
+                'calls': self.calls,
+                'items': self.items,
+                'total_ms': self.total_ns / 1e6,
+                'p50_us': (percentile(samples, 50) or 0) / 1e3,
+                'p99_us': (percentile(samples, 99) or 0) / 1e3,
+                'items_per_sec': self.items / wall if wall else None,
+            }
+
+
+def timed_call(func, item):
+    '''
+    func(item) and its start and duration in ns, module level so it
+    pickles for process pools
+    '''
+    start = time.perf_counter_ns()
+    r = func(item)
+    return r, start, time.perf_counter_ns() - start
+
+
+class MapStage(object):
+    '''
+    apply funcs one after another to each item, on the consumer's thread
+    '''
+
+    def __init__(self, funcs):
+        self.funcs = list(funcs)
+        self.stats = None
+
+    def __call__(self, it):
+        funcs = self.funcs
+        if self.stats is None:
+            for r in it:
+                for f in funcs:
+                    r = f(r)
+                yield r
+            return
+        clock = time.perf_counter_ns
+        timed = list(zip(funcs, self.stats))
+        for r in it:
+            for f, stats in timed:
+                start = clock()
+                r = f(r)
+                stats.record(start, clock() - start)
+            yield r
+
+
+class BatchStage(object):
+    '''
+    apply funcs one after another to whole batches of up to batch items,
+    as made by collate from a list (e.g. numpy.asarray), then yield the
+    items of the result
+    '''
+
+    def __init__(self, funcs, batch, collate=None):
+        self.funcs = list(funcs)
+        self.batch = batch
+        self.collate = collate
+        self.stats = None
+
+    def __call__(self, it):
+        funcs = self.funcs
+        clock = time.perf_counter_ns
+        while True:
+            r = list(itertools.islice(it, self.batch))
+            if not r:
+                return
+            if self.collate is not None:
+                r = self.collate(r)
+            if self.stats is None:
+                for f in funcs:
+                    r = f(r)
+            else:
+                for f, stats in zip(funcs, self.stats):
+                    start = clock()
+                    items = len(r)
+                    r = f(r)
+                    stats.record(start, clock() - start, items)
+            yield from r
+
+
+class FilterStage(object):
+    '''
+    yield the items func is true for
+    '''
+
+    def __init__(self, func):
+        self.funcs = [func]
+        self.stats = None
+
+    def __call__(self, it):
+        func = self.funcs[0]
+        if self.stats is None:
+            yield from filter(func, it)
+            return
+        clock = time.perf_counter_ns
+        stats = self.stats[0]
+        for r in it:
+            start = clock()
+            keep = func(r)
+            stats.record(start, clock() - start)
+            if keep:
+                yield r
+
+
+class FlatMapStage(object):
+    '''
+    yield the items of the iterable func returns for each item, as it
+    produces them
+    '''
+
+    def __init__(self, func):
+        self.funcs = [func]
+        self.stats = None
+
+    def __call__(self, it):
+        func = self.funcs[0]
+        clock = time.perf_counter_ns
+        for r in it:
+            if self.stats is None:
+                yield from func(r)
+            else:
+                start = clock()
+                r = func(r)
+                self.stats[0].record(start, clock() - start)
+                yield from r
+
+
+class WindowStage(object):
+    '''
+    group items into lists of size items, or of the items arriving
+    within seconds of the first, whichever closes first. a time window
+    closes when the next item arrives; the last one at the end
+    '''
+
+    def __init__(self, size=None, seconds=None):
+        if size is None and seconds is None:
+            raise ValueError('a window needs size or seconds')
+        self.size = size
+        self.seconds = seconds
+        self.funcs = []
+        self.stats = None
+
+    def __call__(self, it):
+        window = []
+        deadline = None
+        for r in it:
+            if self.seconds is not None:
+                now = time.monotonic()
+                if window and now >= deadline:
+                    yield window
+                    window = []
+                if not window:
+                    deadline = now + self.seconds
+            window.append(r)
+            if len(window) == self.size:
+                yield window
+                window = []
+        if window:
+            yield window
+
+
+_NO_INITIAL = object()
+
+
+class ReduceStage(object):
+    '''
+    fold all items with func like functools.reduce, yield the result
+    once the source ends
+    '''
+
+    def __init__(self, func, initial=_NO_INITIAL):
+        self.funcs = [func]
+        self.initial = initial
+        self.stats = None
+
+    def __call__(self, it):
+        func = self.funcs[0]
+        it = iter(it)
+        r = self.initial
+        if r is _NO_INITIAL:
+            try:
+                r = next(it)
+            except StopIteration:
+                raise TypeError('reduce of an empty pipeline '
+                                'with no initial value') from None
+        if self.stats is None:
+            for item in it:
+                r = func(r, item)
+        else:
+            clock = time.perf_counter_ns
+            stats = self.stats[0]
+            for item in it:
+                start = clock()
+                r = func(r, item)
+                stats.record(start, clock() - start)
+        yield r
+
+
+class ParallelMapStage(object):
+    '''
+    apply func to items in a pool of workers, 'thread' or 'process'.
+    at most inflight items are submitted ahead of the consumer.
+    ordered yields results in input order, otherwise as completed
+    '''
+
+    def __init__(self, func, workers, executor='thread', ordered=True,
+                 inflight=None):
+        if executor not in ('thread', 'process'):
+            raise ValueError('executor must be thread or process')
+        self.func = func
+        self.workers = workers
+        self.executor = executor
+        self.ordered = ordered
+        self.inflight = inflight or 2 * workers
+        self.stats = None
+
+    @property
+    def funcs(self):
+        return [self.func]
+
+    def _result(self, future):
+        if self.stats is None:
+            return future.result()
+        r, start, ns = future.result()
+        self.stats[0].record(start, ns)
+        return r
+
+    def __call__(self, it):
+        pool = ThreadPoolExecutor(self.workers) \
+            if self.executor == 'thread' else \
+            ProcessPoolExecutor(self.workers)
+        if self.stats is None:
+            submit = functools.partial(pool.submit, self.func)
+        else:
+            submit = functools.partial(pool.submit, timed_call, self.func)
+        pending = collections.deque() if self.ordered else set()
+        try:
+            for item in it:
+                future = submit(item)
+                if self.ordered:
+                    pending.append(future)
+                    if len(pending) >= self.inflight:
+                        yield self._result(pending.popleft())
+                else:
+                    pending.add(future)
+                    if len(pending) >= self.inflight:
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield self._result(future)
+            while pending:
+                if self.ordered:
+                    yield self._result(pending.popleft())
+                else:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._result(future)
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+
+class PrefetchStage(object):
+    '''
+    run everything upstream in a background thread, handing items to
+    the consumer through a queue of depth items: the producer blocks
+    when it is full. exceptions upstream are raised to the consumer.
+    when the consumer closes early the producer stops at its next put
+    and closes upstream, so upstream pools are shut down
+    '''
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.funcs = []
+        self.stats = None
+
+    def __call__(self, it):
+        q = queue.Queue(self.depth)
+        stop = threading.Event()
+
+        def put(entry):
+            # a full queue is not drained any more once stop is set
+            while not stop.is_set():
+                try:
+                    q.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in it:
+                    if not put((True, item)):
+                        break
+                else:
+                    put((False, None))
+            except BaseException as e:
+                put((False, e))
+            finally:
+                close = getattr(it, 'close', None)
+                if stop.is_set() and close is not None:
+                    close()
+
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while True:
+                ok, item = q.get()
+                if ok:
+                    yield item
+                elif item is None:
+                    return
+                else:
+                    raise item
+        finally:
+            # the producer gives up its pending put and stops
+            stop.set()
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
 
 
 class Pipeline(object):
 
     def __init__(self, it):
         self._it = it
-        self._funcs = []
+        self._stages = []
+        self._profile = False
+        self._export = None
+        self._interval = None
 
-    def append(self, *funcs):
+    def append(self, *funcs, workers=None, executor='thread', ordered=True,
+               inflight=None, batch=None, collate=None):
+        '''
+        add funcs as map stages. sequential by default; with workers
+        each func runs in its own pool, see ParallelMapStage; with batch
+        funcs take and return batches, see BatchStage. funcs added
+        together or one after another share a stage and pass batches
+        without flattening them in between
+        '''
+        if batch is not None and workers is not None:
+            raise ValueError('a stage can not have both batch and workers')
         for func in funcs:
-            self._funcs.append(func)
+            last = self._stages[-1] if self._stages else None
+            if batch is not None:
+                if type(last) is BatchStage and last.batch == batch and \
+                        last.collate is collate:
+                    last.funcs.append(func)
+                else:
+                    self._stages.append(BatchStage([func], batch, collate))
+            elif workers is not None:
+                self._stages.append(ParallelMapStage(
+                    func, workers, executor, ordered, inflight))
+            elif type(last) is MapStage:
+                last.funcs.append(func)
+            else:
+                self._stages.append(MapStage([func]))
+        return self
+
+    def filter(self, func):
+        self._stages.append(FilterStage(func))
+        return self
+
+    def flat_map(self, func):
+        self._stages.append(FlatMapStage(func))
+        return self
+
+    def window(self, size=None, seconds=None):
+        '''
+        turn items into lists by count and/or time, see WindowStage
+        '''
+        self._stages.append(WindowStage(size, seconds))
+        return self
+
+    def reduce(self, func, initial=_NO_INITIAL):
+        self._stages.append(ReduceStage(func, initial))
+        return self
+
+    def prefetch(self, depth=16):
+        '''
+        run the source and the stages so far in a background thread,
+        up to depth items ahead of the rest, see PrefetchStage
+        '''
+        self._stages.append(PrefetchStage(depth))
+        return self
+
+    def profile(self, enable=True, export=None, interval=10.0):
+        '''
+        time every stage function from the next iteration on, see
+        stats(); export is called with stats() every interval seconds
+        of iteration and when it ends. disabled, functions are called
+        as is and export is not called
+        '''
+        self._profile = enable
+        self._export = export if enable else None
+        self._interval = interval
         return self
 
+    def stats(self):
+        '''
+        StageStats.summary() of each stage function in order, with the
+        stage index, empty unless profiling
+        '''
+        ret = []
+        for idx, stage in enumerate(self._stages):
+            for stats in stage.stats or []:
+                summary = stats.summary()
+                summary['stage'] = idx
+                ret.append(summary)
+        return ret
+
     def __iter__(self):
-        self._itt = self._it.__iter__()
+        it = self._it.__iter__()
+        for stage in self._stages:
+            stage.stats = [StageStats(getattr(f, '__name__', repr(f)))
+                           for f in stage.funcs] if self._profile else None
+            it = stage(it)
+        self._itt = it
+        self._exported = time.monotonic()
         return self
 
     def __next__(self):
-        r = self._itt.__next__()
-        for f in self._funcs:
-            r = f(r)
+        if self._export is None:
+            return self._itt.__next__()
+        try:
+            r = self._itt.__next__()
+        except StopIteration:
+            self._export(self.stats())
+            raise
+        if time.monotonic() - self._exported >= self._interval:
+            self._exported = time.monotonic()
+            self._export(self.stats())
         return r
 
 
+async def call_stage(func, item):
+    r = func(item)
+    if inspect.isawaitable(r):
+        r = await r
+    return r
+
+
+class AsyncMapStage(object):
+    '''
+    apply funcs one after another to each item, awaiting coroutine
+    functions in turn. plain functions run inline on the loop
+    '''
+
+    def __init__(self, funcs):
+        self.funcs = list(funcs)
+
+    async def __call__(self, it):
+        funcs = self.funcs
+        async for r in it:
+            for f in funcs:
+                r = f(r)
+                if inspect.isawaitable(r):
+                    r = await r
+            yield r
+
+
+class AsyncConcurrentStage(object):
+    '''
+    run func on up to concurrency items at a time as tasks on the loop.
+    ordered yields results in input order, otherwise as completed
+    '''
+
+    def __init__(self, func, concurrency, ordered=True):
+        self.func = func
+        self.concurrency = concurrency
+        self.ordered = ordered
+
+    async def __call__(self, it):
+        pending = collections.deque() if self.ordered else set()
+        try:
+            async for item in it:
+                task = asyncio.ensure_future(call_stage(self.func, item))
+                if self.ordered:
+                    pending.append(task)
+                    if len(pending) >= self.concurrency:
+                        yield await pending.popleft()
+                else:
+                    pending.add(task)
+                    if len(pending) >= self.concurrency:
+                        done, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield task.result()
+            while pending:
+                if self.ordered:
+                    yield await pending.popleft()
+                else:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def async_source(it):
+    for item in it:
+        yield item
+
+
+class AsyncPipeline(object):
+    '''
+    Pipeline over a sync or async iterable for asyncio code, consumed
+    with async for. stages may be plain or coroutine functions
+    '''
+
+    def __init__(self, it):
+        self._it = it
+        self._stages = []
+
+    def append(self, *funcs, concurrency=None, ordered=True):
+        '''
+        add funcs as map stages, awaited one item at a time by default;
+        with concurrency each func runs on that many items at once, see
+        AsyncConcurrentStage
+        '''
+        for func in funcs:
+            last = self._stages[-1] if self._stages else None
+            if concurrency is not None:
+                self._stages.append(
+                    AsyncConcurrentStage(func, concurrency, ordered))
+            elif type(last) is AsyncMapStage:
+                last.funcs.append(func)
+            else:
+                self._stages.append(AsyncMapStage([func]))
+        return self
+
+    def __aiter__(self):
+        if hasattr(self._it, '__aiter__'):
+            it = self._it.__aiter__()
+        else:
+            it = async_source(self._it)
+        for stage in self._stages:
+            it = stage(it)
+        self._itt = it
+        return self
+
+    async def __anext__(self):
+        return await self._itt.__anext__()
+
+
 class TestPipeline(unittest.TestCase):
 
     def test_basic(self):
@@ -45,6 +629,277 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual(dat_expect_1, data1)
         self.assertEqual(dat_expect_2, data2)
 
+    def test_parallel(self):
+        dat = [x for x in range(50)]
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def slow(x):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01 * (x % 3))
+            with lock:
+                running[0] -= 1
+            return x * 2
+
+        ordered = [x for x in Pipeline(dat).append(
+            slow, workers=4, inflight=6).append(lambda x: x + 1)]
+        self.assertEqual([x * 2 + 1 for x in dat], ordered)
+        self.assertLessEqual(running[1], 4)
+        unordered = [x for x in Pipeline(dat).append(
+            slow, workers=4, ordered=False)]
+        self.assertEqual(sorted(unordered), [x * 2 for x in dat])
+        self.assertEqual([abs(x) for x in dat], [x for x in Pipeline(
+            [-x for x in dat]).append(abs, workers=2, executor='process')])
+
+    def test_parallel_error(self):
+        def fail(x):
+            if x == 5:
+                raise ValueError(x)
+            return x
+
+        for ordered in [True, False]:
+            p = Pipeline(range(20)).append(fail, workers=3, ordered=ordered)
+            with self.assertRaises(ValueError):
+                [x for x in p]
+
+    def test_batch(self):
+        dat = [x for x in range(23)]
+        sizes = []
+
+        def double(batch):
+            sizes.append(len(batch))
+            return [x * 2 for x in batch]
+
+        p = Pipeline(dat).append(double, lambda b: [x * 3 for x in b],
+                                 batch=5)
+        self.assertEqual(1, len(p._stages))
+        self.assertEqual([x * 6 for x in dat], [x for x in p])
+        self.assertEqual([5, 5, 5, 5, 3], sizes)
+        p = Pipeline(dat).append(
+            lambda b: b[::-1], batch=4, collate=tuple).append(
+            lambda x: x + 1).append(
+            lambda b: [sum(b)] * len(b), batch=3)
+        expect = [x + 1 for i in range(0, 23, 4) for x in dat[i:i + 4][::-1]]
+        expect = [sum(expect[i:i + 3]) for i in range(0, 23, 3)
+                  for x in expect[i:i + 3]]
+        self.assertEqual(3, len(p._stages))
+        self.assertEqual(expect, [x for x in p])
+        self.assertRaises(ValueError, Pipeline(dat).append, double,
+                          batch=2, workers=2)
+
+    def test_prefetch(self):
+        dat = [x for x in range(100)]
+        read = []
+
+        def source():
+            for x in dat:
+                read.append(x)
+                yield x
+
+        p = Pipeline(source()).append(lambda x: x * 2).prefetch(4).append(
+            lambda x: x + 1).prefetch(2)
+        self.assertEqual([x * 2 + 1 for x in dat], [x for x in p])
+        del read[:]
+        it = iter(Pipeline(source()).prefetch(4))
+        self.assertEqual(0, next(it))
+        time.sleep(0.1)
+        # one taken, four queued, one blocked in put
+        self.assertLessEqual(len(read), 6)
+        it._itt.close()
+        self.assertLessEqual(len(read), 7)
+
+        def fail(x):
+            if x == 50:
+                raise ValueError(x)
+            return x
+
+        p = Pipeline(dat).append(fail).prefetch(4)
+        got = []
+        with self.assertRaises(ValueError):
+            for x in p:
+                got.append(x)
+        self.assertEqual(dat[:50], got)
+        self.assertEqual([], [x for x in Pipeline([]).prefetch()])
+
+    def test_prefetch_close(self):
+        def source():
+            yield from range(3)
+            time.sleep(0.05)  # ends after the consumer closed
+
+        threads = threading.active_count()
+        for _ in range(5):
+            it = iter(Pipeline(source()).append(
+                lambda x: x, workers=2).prefetch(1))
+            self.assertEqual(0, next(it))
+            time.sleep(0.01)  # the producer blocks on a full queue
+            it._itt.close()
+        # producers and the pools they closed upstream are gone
+        time.sleep(0.5)
+        self.assertEqual(threads, threading.active_count())
+
+    def test_profile(self):
+        def slow(x):
+            time.sleep(0.001)
+            return x
+
+        def double(x):
+            return x * 2
+
+        dat = [x for x in range(40)]
+        p = Pipeline(dat).append(double)
+        self.assertEqual([x * 2 for x in dat], [x for x in p])
+        self.assertEqual([], p.stats())
+        exports = []
+        p = Pipeline(dat).append(double, slow).append(
+            lambda b: b, batch=8).prefetch(4).append(
+            slow, workers=2).profile(export=exports.append, interval=0)
+        self.assertEqual([x * 2 for x in dat], [x for x in p])
+        stats = p.stats()
+        self.assertEqual(['double', 'slow', '<lambda>', 'slow'],
+                         [x['name'] for x in stats])
+        self.assertEqual([0, 0, 1, 3], [x['stage'] for x in stats])
+        self.assertEqual([40, 40, 5, 40], [x['calls'] for x in stats])
+        self.assertEqual([40] * 4, [x['items'] for x in stats])
+        for x in stats:
+            self.assertLessEqual(x['p50_us'], x['p99_us'])
+            self.assertGreater(x['items_per_sec'], 0)
+        self.assertGreaterEqual(stats[1]['p50_us'], 1000)
+        self.assertEqual(41, len(exports))
+        self.assertEqual(stats, exports[-1])
+        exports = []
+        p = Pipeline(dat).append(double).profile(
+            False, export=exports.append, interval=0)
+        self.assertEqual([x * 2 for x in dat], [x for x in p])
+        self.assertEqual([], exports)
+
+    def test_filter_flat_map(self):
+        dat = [x for x in range(20)]
+        p = Pipeline(dat).filter(lambda x: x % 3 == 0).flat_map(
+            lambda x: range(x)).append(lambda x: x * 2)
+        self.assertEqual([y * 2 for x in dat if x % 3 == 0 for y in range(x)],
+                         [x for x in p])
+        # lazy: an endless source is fine when the consumer stops
+        p = Pipeline(itertools.count()).flat_map(lambda x: [x] * x)
+        self.assertEqual([1, 2, 2, 3, 3, 3], list(itertools.islice(p, 6)))
+
+    def test_window(self):
+        dat = [x for x in range(10)]
+        self.assertEqual([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]],
+                         [x for x in Pipeline(dat).window(4)])
+        p = Pipeline(itertools.count()).window(3).append(sum)
+        self.assertEqual([3, 12, 21], list(itertools.islice(p, 3)))
+
+        def source():
+            for x in dat:
+                if x in (4, 7):
+                    time.sleep(0.05)
+                yield x
+
+        self.assertEqual(
+            [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]],
+            [x for x in Pipeline(source()).window(seconds=0.04)])
+        self.assertEqual(
+            [[0, 1], [2, 3], [4, 5], [6], [7, 8], [9]],
+            [x for x in Pipeline(source()).window(2, seconds=0.04)])
+        self.assertRaises(ValueError, Pipeline(dat).window)
+
+    def test_reduce(self):
+        dat = [x for x in range(10)]
+        self.assertEqual([45], [x for x in Pipeline(dat).reduce(
+            lambda x, y: x + y)])
+        self.assertEqual([[4, 9]], [x for x in Pipeline(dat).window(
+            5).append(max).reduce(lambda x, y: x + [y], [])])
+        self.assertEqual([7], [x for x in Pipeline([]).reduce(max, 7)])
+        with self.assertRaises(TypeError):
+            [x for x in Pipeline([]).reduce(max)]
+
+
+class TestAsyncPipeline(unittest.TestCase):
+
+    def collect(self, p):
+        async def run():
+            return [x async for x in p]
+        return asyncio.run(run())
+
+    def test_basic(self):
+        dat = [x for x in range(10)]
+
+        async def triple(x):
+            await asyncio.sleep(0)
+            return x * 3
+
+        async def source():
+            for x in dat:
+                yield x
+
+        self.assertEqual(dat, self.collect(AsyncPipeline(dat)))
+        p = AsyncPipeline(source()).append(lambda x: x * 2, triple)
+        self.assertEqual(1, len(p._stages))
+        self.assertEqual([x * 6 for x in dat], self.collect(p))
+
+    def test_concurrency(self):
+        dat = [x for x in range(30)]
+        running = [0, 0]
+
+        async def lookup(x):
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01 * (x % 3))
+            running[0] -= 1
+            return x * 2
+
+        start = time.monotonic()
+        ordered = self.collect(AsyncPipeline(dat).append(
+            lookup, concurrency=5).append(lambda x: x + 1))
+        self.assertEqual([x * 2 + 1 for x in dat], ordered)
+        self.assertEqual(5, running[1])
+        self.assertLess(time.monotonic() - start, 0.01 * len(dat))
+        unordered = self.collect(AsyncPipeline(dat).append(
+            lookup, concurrency=5, ordered=False))
+        self.assertNotEqual([x * 2 for x in dat], unordered)
+        self.assertEqual([x * 2 for x in dat], sorted(unordered))
+
+    def test_error(self):
+        async def fail(x):
+            if x == 5:
+                raise ValueError(x)
+            return x
+
+        for ordered in [True, False]:
+            p = AsyncPipeline(range(20)).append(
+                fail, concurrency=3, ordered=ordered)
+            with self.assertRaises(ValueError):
+                self.collect(p)
+
+
+def bench_prefetch(n=200, io=0.002, cpu=0.002):
+    def source():
+        for x in range(n):
+            time.sleep(io)
+            yield x
+
+    def work(x):
+        end = time.perf_counter() + cpu
+        while time.perf_counter() < end:
+            pass
+        return x
+
+    for depth in [None, 1, 16]:
+        p = Pipeline(source())
+        if depth is not None:
+            p.prefetch(depth)
+        p.append(work)
+        start = time.perf_counter()
+        for x in p:
+            pass
+        print('{n} items, prefetch {d}: {c:.3f}s'.format(
+            n=n, d=depth, c=time.perf_counter() - start))
+
 
 if __name__ == "__main__":
-    unittest.main()
+    if sys.argv[1:2] == ['bench']:
+        bench_prefetch()
+    else:
+        unittest.main()
@@ -5,12 +5,25 @@ An updated version of https://github.com/x007007007/sshtunnel
 Adapted to suite Python 3
 '''
 
+import asyncio
+import bisect
+import collections
+import fcntl
+import http.server
+import os
 import socketserver
 import struct
 import socket
 import select
 import paramiko
 import threading
+import time
+import types
+import unittest
+import weakref
+
+
+RELAY_BUFSIZE = 64 * 1024
 
 
 class SocksException(Exception):
@@ -62,6 +75,13 @@ class SocksRemoteException(SocksException):
     pass
 
 
+class SocksRemoteRefused(SocksRemoteException):
+    """
+        remote refused to open channel to destination
+    """
+    pass
+
+
 class SocksClientException(SocksException):
     """
         client error
@@ -69,6 +89,247 @@ class SocksClientException(SocksException):
     pass
 
 
+def socks5_bnd_msg(atype, addr, port):
+    """
+        build success BND protocol return sequences
+    """
+    if atype == b'\x01':  # ipv4
+        return b'\x05\x00\x00\x01%s%s' % (
+            socket.inet_aton(addr),
+            struct.pack(">H", port))
+    elif atype == b'\x03':  # domain
+        return b'\x05\x00\x00\x03%s%s%s' % (
+            struct.pack('>H', len(addr)),
+            addr,
+            struct.pack(">H", port))
+    elif atype == b'\x04':  # ipv6
+        return b'\x05\x00\x00\x04%s%s' % (
+            socket.inet_pton(socket.AF_INET6, addr),
+            struct.pack(">H", port))
+    raise SocksAddressTypeDisabled
+
+
+def _sendall(peer, data):
+    """
+        send all of data, return False if peer is closed
+    """
+    view = memoryview(data)
+    while view:
+        sent = peer.send(view)
+        if sent <= 0:
+            return False
+        view = view[sent:]
+    return len(data) > 0
+
+
+class SocksMetrics(object):
+    """
+    traffic counters of a socks server in prometheus text format.
+    open connections are registered with their traffic list, that
+    their relay adds bytes to without the lock, and render() sums
+    them with the totals of closed ones. so the lock is taken a few
+    times per connection and never per packet.
+    destinations beyond max_destinations are summed as 'other'
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    max_destinations = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.live = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.destinations = {}
+        self.handshake_failures = collections.Counter()
+        self.connect_failures = 0
+        self.channel_open = {}
+        self.channel_refused = collections.Counter()
+        self.reconnects = collections.Counter()
+
+    def open_connection(self, conn):
+        '''
+        register conn, which has dst, None until known, and traffic,
+        a list of bytes from the remote side and from the client.
+        return its id for close_connection
+        '''
+        with self._lock:
+            self.connections += 1
+            self.live[self.connections] = conn
+            return self.connections
+
+    def close_connection(self, conn_id):
+        with self._lock:
+            conn = self.live.pop(conn_id)
+            bytes_in, bytes_out = conn.traffic
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            dst = self._destination(conn.dst)
+            if dst is None:
+                return
+            counts = self.destinations.setdefault(dst, [0, 0])
+            counts[0] += bytes_in
+            counts[1] += bytes_out
+
+    def _destination(self, dst):
+        if dst is None:
+            return None
+        dst = '{h}:{p}'.format(h=dst[0], p=dst[1])
+        if dst not in self.destinations and \
+                len(self.destinations) >= self.max_destinations:
+            return 'other'
+        return dst
+
+    def handshake_failed(self, reason):
+        with self._lock:
+            self.handshake_failures[reason] += 1
+
+    def connect_failed(self):
+        with self._lock:
+            self.connect_failures += 1
+
+    def channel_opened(self, upstream, seconds):
+        with self._lock:
+            hist = self.channel_open.get(upstream)
+            if hist is None:
+                hist = self.channel_open[upstream] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            hist[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            hist[1] += seconds
+
+    def refused(self, upstream):
+        with self._lock:
+            self.channel_refused[upstream] += 1
+
+    def reconnected(self, upstream):
+        with self._lock:
+            self.reconnects[upstream] += 1
+
+    @staticmethod
+    def _sample(name, value, **labels):
+        if labels:
+            name += '{' + ','.join('{k}="{v}"'.format(
+                k=k, v=str(v).replace('\\', '\\\\').replace(
+                    '"', '\\"').replace('\n', '\\n'))
+                for k, v in sorted(labels.items())) + '}'
+        return '{n} {v}'.format(n=name, v=value)
+
+    def render(self):
+        out = []
+
+        def header(name, kind, doc):
+            out.append('# HELP {n} {d}'.format(n=name, d=doc))
+            out.append('# TYPE {n} {k}'.format(n=name, k=kind))
+
+        sample = self._sample
+        with self._lock:
+            live = []
+            bytes_in, bytes_out = self.bytes_in, self.bytes_out
+            destinations = {k: list(v) for k, v in self.destinations.items()}
+            for conn_id, conn in sorted(self.live.items()):
+                traffic = tuple(conn.traffic)
+                dst = self._destination(conn.dst)
+                live.append((conn_id, dst, traffic))
+                bytes_in += traffic[0]
+                bytes_out += traffic[1]
+                if dst is not None:
+                    counts = destinations.setdefault(dst, [0, 0])
+                    counts[0] += traffic[0]
+                    counts[1] += traffic[1]
+            header('g4z3_socks_connections_total', 'counter',
+                   'socks connections accepted')
+            out.append(sample('g4z3_socks_connections_total',
+                              self.connections))
+            header('g4z3_socks_active_connections', 'gauge',
+                   'socks connections open')
+            out.append(sample('g4z3_socks_active_connections', len(live)))
+            header('g4z3_socks_bytes_total', 'counter',
+                   'bytes relayed, in from remotes, out from clients')
+            out.append(sample('g4z3_socks_bytes_total', bytes_in,
+                              direction='in'))
+            out.append(sample('g4z3_socks_bytes_total', bytes_out,
+                              direction='out'))
+            header('g4z3_socks_connection_bytes_total', 'counter',
+                   'bytes relayed per open connection')
+            for conn_id, dst, (bytes_in, bytes_out) in live:
+                labels = {'connection': conn_id}
+                if dst is not None:
+                    labels['destination'] = dst
+                out.append(sample('g4z3_socks_connection_bytes_total',
+                                  bytes_in, direction='in', **labels))
+                out.append(sample('g4z3_socks_connection_bytes_total',
+                                  bytes_out, direction='out', **labels))
+            header('g4z3_socks_destination_bytes_total', 'counter',
+                   'bytes relayed per destination')
+            for dst, (bytes_in, bytes_out) in sorted(destinations.items()):
+                out.append(sample('g4z3_socks_destination_bytes_total',
+                                  bytes_in, destination=dst, direction='in'))
+                out.append(sample('g4z3_socks_destination_bytes_total',
+                                  bytes_out, destination=dst,
+                                  direction='out'))
+            header('g4z3_socks_handshake_failures_total', 'counter',
+                   'socks handshakes failed before a connect')
+            for reason, n in sorted(self.handshake_failures.items()):
+                out.append(sample('g4z3_socks_handshake_failures_total', n,
+                                  reason=reason))
+            header('g4z3_socks_connect_failures_total', 'counter',
+                   'socks connects no remote could be opened for')
+            out.append(sample('g4z3_socks_connect_failures_total',
+                              self.connect_failures))
+            header('g4z3_ssh_channel_open_seconds', 'histogram',
+                   'time to open a ssh channel')
+            for upstream, (counts, total) in sorted(
+                    self.channel_open.items()):
+                n = 0
+                for le, count in zip(self.buckets + ('+Inf',), counts):
+                    n += count
+                    out.append(sample('g4z3_ssh_channel_open_seconds_bucket',
+                                      n, upstream=upstream, le=le))
+                out.append(sample('g4z3_ssh_channel_open_seconds_sum',
+                                  total, upstream=upstream))
+                out.append(sample('g4z3_ssh_channel_open_seconds_count',
+                                  n, upstream=upstream))
+            header('g4z3_ssh_channel_refused_total', 'counter',
+                   'ssh channels refused by the remote')
+            for upstream, n in sorted(self.channel_refused.items()):
+                out.append(sample('g4z3_ssh_channel_refused_total', n,
+                                  upstream=upstream))
+            header('g4z3_ssh_reconnects_total', 'counter',
+                   'ssh conversations dropped and reconnected')
+            for upstream, n in sorted(self.reconnects.items()):
+                out.append(sample('g4z3_ssh_reconnects_total', n,
+                                  upstream=upstream))
+        return '\n'.join(out) + '\n'
+
+    def serve(self, address):
+        '''
+        serve render() on http://address/metrics in a daemon thread,
+        return the http server for shutdown()
+        '''
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return server
+
+
 class SocksRequestHandler(socketserver.StreamRequestHandler):
     """
         defined get_sockes5_* functions to get remote socket for
@@ -142,47 +403,126 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
     def handle(self):
         """
             required entry to judge protocol version,
-            select deal method and call it
+            select deal method and call it.
+            bytes relayed are counted in traffic, from remote and
+            from client, which server.metrics reads while open
         """
-        recv = self.request.recv(512)
-        self.log('debug', 'recv msg:%r' % recv)
-        if recv[0] == 4:
-            self.handle_socks4(recv)
-        elif recv[0] == 5:
-            self.handle_socks5(recv)
+        metrics = getattr(self.server, 'metrics', None)
+        self.traffic = [0, 0]
+        self.dst = None
+        self.connected = False
+        if metrics is not None:
+            conn_id = metrics.open_connection(self)
+        try:
+            recv = self.request.recv(512)
+            self.log('debug', 'recv msg:%r' % recv)
+            if not recv:
+                return
+            if recv[0] == 4:
+                self.handle_socks4(recv)
+            elif recv[0] == 5:
+                self.handle_socks5(recv)
+            elif metrics is not None:
+                metrics.handshake_failed('version')
+        finally:
+            if metrics is not None:
+                metrics.close_connection(conn_id)
 
     def handle_socks4(self, recv):
         pass
 
-    def handle_socks5(self, recv):
-        def exchange_data(remote_peer, local_peer, debug=None):
-            """
-                exchange ssh channel socket with socks socket
-            """
+    def exchange_data(self, remote_peer, local_peer):
+        """
+            exchange remote socket or ssh channel with socks socket,
+            two real sockets are spliced inside the kernel
+        """
+        bufsize = getattr(self.server, 'bufsize', RELAY_BUFSIZE)
+        if (hasattr(os, 'splice') and
+                isinstance(remote_peer, socket.socket) and
+                isinstance(local_peer, socket.socket)):
+            self.splice_data(remote_peer, local_peer, bufsize)
+        else:
+            self.copy_data(remote_peer, local_peer, bufsize)
+
+    def copy_data(self, remote_peer, local_peer, bufsize):
+        """
+            relay through one preallocated buffer per direction
+        """
+        peers = {remote_peer: local_peer, local_peer: remote_peer}
+        errors = {remote_peer: SocksRemoteException,
+                  local_peer: SocksClientException}
+        slots = {remote_peer: 0, local_peer: 1}
+        traffic = self.traffic
+        bufs = {x: memoryview(bytearray(bufsize)) for x in peers}
+        while True:
+            r, _, _ = select.select([remote_peer, local_peer], [], [])
+            for src in r:
+                dst = peers[src]
+                buf = bufs[src]
+                try:
+                    if hasattr(src, 'recv_into'):
+                        size = src.recv_into(buf)
+                        data = buf[:size]
+                    else:  # ssh channel
+                        data = src.recv(bufsize)
+                except (socket.error, socket.timeout) as e:
+                    raise errors[src](e)
+                traffic[slots[src]] += len(data)
+                try:
+                    if not _sendall(dst, data):
+                        return
+                except (socket.error, socket.timeout) as e:
+                    raise errors[dst](e)
+
+    def splice_data(self, remote_peer, local_peer, bufsize):
+        """
+            relay through one pipe per direction with os.splice,
+            data never enters user space
+        """
+        peers = {remote_peer: local_peer, local_peer: remote_peer}
+        errors = {remote_peer: SocksRemoteException,
+                  local_peer: SocksClientException}
+        slots = {remote_peer: 0, local_peer: 1}
+        traffic = self.traffic
+        pipes = {x: os.pipe() for x in peers}
+        try:
+            for rfd, _ in pipes.values():
+                try:
+                    fcntl.fcntl(rfd, fcntl.F_SETPIPE_SZ, bufsize)
+                except (AttributeError, OSError):
+                    pass  # keep default pipe size
             while True:
-                r, _, e = select.select([remote_peer, local_peer],
-                                        [], [])
-                if remote_peer in r:
-                    try:
-                        recv = remote_peer.recv(4096)
-                    except (socket.error, socket.timeout) as e:
-                        raise SocksRemoteException(e.message)
-                    try:
-                        if local_peer.send(recv) <= 0:
-                            break  # remote data --> local client
-                    except (socket.error, socket.timeout) as e:
-                        raise SocksClientException(e.message)
-                if local_peer in r:
+                r, _, _ = select.select([remote_peer, local_peer], [], [])
+                for src in r:
+                    dst = peers[src]
+                    rfd, wfd = pipes[src]
                     try:
-                        recv = local_peer.recv(4096)
-                    except (socket.error, socket.timeout) as e:
-                        raise SocksClientException(e.message)
-                    try:
-                        if remote_peer.send(recv) <= 0:
-                            break  # local client --> remote server
-                    except (socket.error, socket.timeout) as e:
-                        raise SocksRemoteException(e.message)
+                        size = os.splice(src.fileno(), wfd, bufsize,
+                                         flags=os.SPLICE_F_MOVE)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        raise errors[src](e)
+                    if size == 0:
+                        return
+                    traffic[slots[src]] += size
+                    while size > 0:
+                        try:
+                            size -= os.splice(rfd, dst.fileno(), size,
+                                              flags=os.SPLICE_F_MOVE)
+                        except (BlockingIOError, InterruptedError):
+                            _, w, _ = select.select([], [dst], [],
+                                                    dst.gettimeout())
+                            if not w:
+                                raise errors[dst]('timed out')
+                        except OSError as e:
+                            raise errors[dst](e)
+        finally:
+            for rfd, wfd in pipes.values():
+                os.close(rfd)
+                os.close(wfd)
 
+    def handle_socks5(self, recv):
         def reply_client_bnd(atype, addr, port):
             """
                 return success BND protocol return sequences
@@ -190,23 +530,10 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
             self.log('debug', 'atype:%r ,(%s,%d)' % (atype,
                                                      addr,
                                                      port))
-            if atype == b'\x01':  # ipv4
-                msg = b'\x05\x00\x00\x01%s%s' % (
-                    socket.inet_aton(addr),
-                    struct.pack(">H", port))
-            elif atype == b'\x03':  # domain
-                msg = b'\x05\x00\x00\x03%s%s%s' % (
-                    struct.pack('>H', len(addr)),
-                    addr,
-                    struct.pack(">H", port))
-            elif atype == b'\x04':  # ipv6
-                msg = b'\x05\x00\x00\x04%s%s' % (
-                    socket.inet_pton(socket.AF_INET6, addr),
-                    struct.pack(">H", port))
-            else:
-                raise SocksAddressTypeDisabled
+            msg = socks5_bnd_msg(atype, addr, port)
             self.log('debug', 'send to client:%r' % msg)
             self.request.send(msg)
+            self.connected = True
 
         try:
             nmethod, = struct.unpack('b', recv[1:2])
@@ -229,7 +556,7 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
                 addr = socket.inet_ntoa(self.request.recv(4))
             elif atype == b'\x03':  # domain
                 addr = self.request.recv(
-                    ord(self.request.recv(1)[0]))
+                    self.request.recv(1)[0]).decode()
             elif atype == b'\x04':  # ipv6
                 addr = socket.inet_ntop(socket.AF_INET6,
                                         self.request.recv(16))
@@ -237,6 +564,7 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
                 raise SocksAddressTypeDisabled
             port = struct.unpack('>H', self.request.recv(2))[0]
             self.log('notify', 'client request:(%s,%d)' % (addr, port))
+            self.dst = (addr, port)
 
             if cmd == b'\x01':  # connect
                 remote_sp, remote_atype = \
@@ -245,7 +573,7 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
                                         atype)
                 # don't get remote socket
                 if remote_sp is None:
-                    return
+                    raise SocksRemoteException('no remote socket')
                 try:
                     bnd_addr, bnd_port = remote_sp.getpeername()
                 except socket.error as e:
@@ -254,7 +582,7 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
                          'connect remote bnd:(%s,%d)' % (bnd_addr,
                                                          bnd_port))
                 reply_client_bnd(remote_atype, bnd_addr, bnd_port)
-                exchange_data(remote_sp, self.request)
+                self.exchange_data(remote_sp, self.request)
             elif cmd == b'\x02':  # bind
                 remote_sp, remote_atype = \
                     self.get_s5_bind_sp((addr, port), \
@@ -270,11 +598,19 @@ class SocksRequestHandler(socketserver.StreamRequestHandler):
                          'bind remote bnd:(%s,%d)' % (bnd_addr,
                                                     bnd_port))
                 reply_client_bnd(remote_atype, bnd_addr, bnd_port)
-                exchange_data(remote_sp, self.request)
+                self.exchange_data(remote_sp, self.request)
             elif cmd == b'\x03':  # udp
                 pass
         except SocksException as e:
-            self.log('warning', 'SocksException:%s' % e.message)
+            self.log('warning', 'SocksException:%s' % e)
+            if isinstance(e, SocksRemoteRefused) and not self.connected:
+                self.request.send(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+            metrics = getattr(self.server, 'metrics', None)
+            if metrics is not None and not self.connected:
+                if isinstance(e, SocksRemoteException):
+                    metrics.connect_failed()
+                else:
+                    metrics.handshake_failed(type(e).__name__)
 #         except socket.error,e:
 #             print 'socket.error',e.message
 
@@ -296,9 +632,9 @@ class SocksRemoteRequestHandler(object):
                 remote.connect(dst)
             return remote, remote_atype
         except socket.timeout as e:
-            print('timeout', dst, src, e.message)
+            print('timeout', dst, src, e)
         except socket.error as e:
-            print('socket error', dst, src, e.message)
+            print('socket error', dst, src, e)
         return None, None
 
     def bind_handle(self, dst, src, dst_type=b'\x01'):
@@ -307,16 +643,304 @@ class SocksRemoteRequestHandler(object):
     def udp_handle(self, dst, src, dst_type=b'\x01'):
         return None, None
 
+    def warm(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SSHTransportPool(object):
+    """
+    keep size ssh conversations to the same host.
+    channels are spread over them by balance:
+        'least' picks the conversation with least open channels
+        'round' picks them in turn
+    a retired conversation is replaced in background, only when no
+    conversation is alive get() blocks on connecting one.
+    keepalive sends ssh keepalives every keepalive seconds so idle
+    conversations are not dropped by the server or by NAT.
+    """
+    retry_delay = 5
+
+    def __init__(self, factory, size=1, balance='least', keepalive=None):
+        if balance not in ('least', 'round'):
+            raise ValueError('unknown balance {b}'.format(b=balance))
+        self._factory = factory
+        self._size = size
+        self._balance = balance
+        self._keepalive = keepalive
+        self._slots = [None] * size
+        self._channels = [weakref.WeakSet() for _ in range(size)]
+        self._replacing = set()
+        self._retry_at = [0] * size
+        self._next = 0
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+
+    @staticmethod
+    def alive(conversation):
+        if conversation is None:
+            return False
+        trans = conversation.get_transport()
+        return trans is not None and trans.is_active()
+
+    def get(self):
+        '''
+        return a live conversation
+        '''
+        with self._lock:
+            slot = self._pick()
+        if slot is None:
+            with self._connect_lock:
+                with self._lock:
+                    slot = self._pick()
+                if slot is None:
+                    conversation = self._factory()
+                    with self._lock:
+                        slot = self._install(conversation)
+        with self._lock:
+            self._refill()
+            return self._slots[slot]
+
+    def track(self, conversation, channel):
+        '''
+        count channel as open on conversation
+        '''
+        with self._lock:
+            for i, x in enumerate(self._slots):
+                if x is conversation:
+                    self._channels[i].add(channel)
+
+    def retire(self, conversation):
+        '''
+        drop a failed conversation and start replacing it
+        '''
+        with self._lock:
+            for i, x in enumerate(self._slots):
+                if x is conversation:
+                    self._slots[i] = None
+            self._refill()
+        conversation.close()
+
+    def fill(self):
+        '''
+        connect every slot in background, so the first connect
+        does not pay for key exchange and authentication
+        '''
+        with self._lock:
+            self._refill(force=True)
+
+    def close(self):
+        with self._lock:
+            slots = self._slots
+            self._slots = [None] * self._size
+        for x in slots:
+            if x is not None:
+                x.close()
+
+    def _open_channels(self, slot):
+        return sum(1 for x in self._channels[slot] if not x.closed)
+
+    def _pick(self):
+        alive = [i for i in range(self._size) if self.alive(self._slots[i])]
+        if not alive:
+            return None
+        if self._balance == 'round':
+            slot = min(alive, key=lambda i: (i - self._next) % self._size)
+            self._next = (slot + 1) % self._size
+            return slot
+        return min(alive, key=self._open_channels)
+
+    def _install(self, conversation):
+        for i in range(self._size):
+            if not self.alive(self._slots[i]):
+                self._set_slot(i, conversation)
+                return i
+        conversation.close()
+        return self._pick()
+
+    def _set_slot(self, slot, conversation):
+        if self._keepalive:
+            conversation.get_transport().set_keepalive(self._keepalive)
+        self._slots[slot] = conversation
+        self._channels[slot] = weakref.WeakSet()
+
+    def _refill(self, force=False):
+        if not force and not any(self.alive(x) for x in self._slots):
+            return  # next get() connects in foreground
+        now = time.monotonic()
+        for i in range(self._size):
+            if (self.alive(self._slots[i]) or i in self._replacing or
+                    self._retry_at[i] > now):
+                continue
+            self._replacing.add(i)
+            t = threading.Thread(target=self._replace, args=(i,))
+            t.daemon = True
+            t.start()
+
+    def _replace(self, slot):
+        try:
+            conversation = self._factory()
+        except (SocksException, paramiko.SSHException, socket.error):
+            conversation = None
+        with self._lock:
+            self._replacing.discard(slot)
+            if conversation is None:
+                self._retry_at[slot] = time.monotonic() + self.retry_delay
+            elif not self.alive(self._slots[slot]):
+                self._set_slot(slot, conversation)
+                conversation = None
+        if conversation is not None:
+            conversation.close()
+
+
+class WarmChannelCache(object):
+    """
+    count connects per destination and keep spares channels opened
+    ahead to the hot most frequent ones, so a connect to them skips
+    the open_channel round trip. a destination needs min_count
+    connects before it can be hot, so one-off ones are not warmed.
+    a spare channel is a real connection on the remote side and
+    servers close idle connections, so spares older than max_age
+    seconds or already closed are dropped by a reaper thread instead
+    of handed out.
+    counts are halved every decay connects so the hot set follows
+    the traffic.
+    """
+
+    def __init__(self, opener, hot=8, spares=1, max_age=10, decay=1024,
+                 min_count=4):
+        """
+        opener(dst) returns a new channel to dst
+        """
+        self._opener = opener
+        self._hot = hot
+        self._max_age = max_age
+        self._decay = decay
+        self._min_count = min_count
+        self._nspares = spares
+        self._counts = collections.Counter()
+        self._hits = 0
+        self._hotset = set()
+        self._spares = {}
+        self._filling = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        reaper = threading.Thread(target=self._reap)
+        reaper.daemon = True
+        reaper.start()
+
+    def get(self, dst):
+        '''
+        count a connect to dst, return a spare channel to it or None
+        '''
+        stale = []
+        with self._lock:
+            self._count(dst)
+            if dst in self._spares:
+                stale = self._expire(dst)
+            spares = self._spares.get(dst)
+            chan = spares.popleft()[1] if spares else None
+            fill = dst in self._hotset and dst not in self._filling
+            if fill:
+                self._filling.add(dst)
+        for x in stale:
+            x.close()
+        if fill:
+            t = threading.Thread(target=self._fill, args=(dst,))
+            t.daemon = True
+            t.start()
+        return chan
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            spares = self._spares
+            self._spares = {}
+        for x in spares.values():
+            for _, chan in x:
+                chan.close()
+
+    def _reap(self):
+        while not self._closed.wait(self._max_age / 2):
+            stale = []
+            with self._lock:
+                for k in list(self._spares):
+                    stale.extend(self._expire(k))
+            for x in stale:
+                x.close()
+
+    def _count(self, dst):
+        self._counts[dst] += 1
+        self._hits += 1
+        if self._hits % self._decay == 0:
+            for k in list(self._counts):
+                self._counts[k] //= 2
+                if not self._counts[k]:
+                    del self._counts[k]
+        if self._hits % 64 == 0:
+            self._hotset = set(
+                x for x, n in self._counts.most_common(self._hot)
+                if n >= self._min_count)
+        elif (len(self._hotset) < self._hot and
+              self._counts[dst] >= self._min_count):
+            self._hotset.add(dst)
+
+    def _expire(self, dst):
+        spares = self._spares[dst]
+        now = time.monotonic()
+        stale = []
+        while spares and (now - spares[0][0] > self._max_age or
+                          spares[0][1].closed or
+                          spares[0][1].eof_received):
+            stale.append(spares.popleft()[1])
+        if not spares:
+            del self._spares[dst]
+        return stale
+
+    def _fill(self, dst):
+        try:
+            while True:
+                with self._lock:
+                    if (self._closed.is_set() or dst not in self._hotset or
+                            len(self._spares.get(dst, ())) >= self._nspares):
+                        return
+                try:
+                    chan = self._opener(dst)
+                except (SocksException, paramiko.SSHException, socket.error):
+                    return
+                with self._lock:
+                    if not self._closed.is_set():
+                        self._spares.setdefault(
+                            dst, collections.deque()).append(
+                                (time.monotonic(), chan))
+                        chan = None
+                if chan is not None:
+                    chan.close()
+                    return
+        finally:
+            with self._lock:
+                self._filling.discard(dst)
+
 
 class SocksSSHRemoteRequestHandler(SocksRemoteRequestHandler):
     """
-    create a ssh channel
+    create a ssh channel on one of pool_size ssh conversations,
+    with warm > 0 spare channels are kept open to the warm most
+    frequent destinations. channel opens, refusals and reconnects
+    are counted in metrics, a SocksMetrics, if given.
+    connecting gives up after connect_timeout seconds, a dropped
+    conversation is reconnected up to retry_limit times per connect
     """
-    old_conversation = None
     errnum = 0
     reconnectnum = 0
+    connect_timeout = 5
+    retry_limit = 5
 
-    def __init__(self, domain, username, keyfile, port=22):
+    def __init__(self, domain, username, keyfile, port=22,
+                 pool_size=1, balance='least', warm=0, keepalive=30,
+                 metrics=None):
         """
         init ssh info
         """
@@ -324,6 +948,13 @@ class SocksSSHRemoteRequestHandler(SocksRemoteRequestHandler):
         self.username = username
         self.keyfile = keyfile
         self.port = port
+        self.name = '{d}:{p}'.format(d=domain, p=port)
+        self.metrics = metrics
+        self.pool = SSHTransportPool(self.get_conversation,
+                                     pool_size, balance, keepalive)
+        self.warm_cache = None
+        if warm > 0:
+            self.warm_cache = WarmChannelCache(self.open_spare, hot=warm)
 
     def get_conversation(self):
         '''
@@ -337,7 +968,10 @@ class SocksSSHRemoteRequestHandler(SocksRemoteRequestHandler):
             conversation.connect(self.domain,
                                  port=self.port,
                                  username=self.username,
-                                 key_filename=self.keyfile)
+                                 key_filename=self.keyfile,
+                                 timeout=self.connect_timeout,
+                                 banner_timeout=self.connect_timeout,
+                                 auth_timeout=self.connect_timeout)
         except socket.gaierror:
             raise SocksRemoteException('Failed connecting to remote server')
         except paramiko.AuthenticationException:
@@ -345,7 +979,12 @@ class SocksSSHRemoteRequestHandler(SocksRemoteRequestHandler):
         except paramiko.BadHostKeyException:
             raise SocksRemoteException('Host key invalid')
         except socket.timeout:
-            return self.get_conversation()
+            conversation.close()
+            raise SocksRemoteException('Timeout connecting to remote server')
+        except (paramiko.SSHException, socket.error) as e:
+            conversation.close()
+            raise SocksRemoteException(
+                'Failed connecting to remote server: {e}'.format(e=e))
         return conversation
 
     def get_socket(self, conversation, dst, src):
@@ -363,36 +1002,173 @@ class SocksSSHRemoteRequestHandler(SocksRemoteRequestHandler):
                 return res
             except paramiko.ChannelException as e:
                 self.errnum += 1
-                raise SocksRemoteException(e.message)
+                if self.metrics is not None:
+                    self.metrics.refused(self.name)
+                raise SocksRemoteRefused(str(e))
+
+    def open_spare(self, dst):
+        conversation = self.pool.get()
+        try:
+            sp = self.get_socket(conversation, dst, ('127.0.0.1', 0))
+        except paramiko.SSHException:
+            self.pool.retire(conversation)
+            raise
+        self.pool.track(conversation, sp)
+        return sp
+
+    def warm(self):
+        self.pool.fill()
 
     def connect_handle(self, dst, src, dst_type=b'\x01'):
-        retry_limit = 5
-        if self.old_conversation is None:
-            self.old_conversation = self.get_conversation()
+        if self.warm_cache is not None:
+            sp = self.warm_cache.get(dst)
+            if sp is not None:
+                return sp, b'\x01'
+        return self.open_handle(dst, src, dst_type)
+
+    def open_handle(self, dst, src, dst_type=b'\x01'):
+        conversation = self.pool.get()
+        start = time.monotonic()
         try:
-            sp = self.get_socket(self.old_conversation, dst, src)
+            sp = self.get_socket(conversation, dst, src)
             self.reconnectnum = 0
         except paramiko.SSHException:
-            if not self.reconnectnum > retry_limit:
+            self.pool.retire(conversation)
+            if self.metrics is not None:
+                self.metrics.reconnected(self.name)
+            if not self.reconnectnum >= self.retry_limit:
                 self.reconnectnum += 1
-                self.old_conversation = self.get_conversation()
-                return self.connect_handle(dst, src, dst_type)
+                return self.open_handle(dst, src, dst_type)
             else:
+                self.reconnectnum = 0
                 raise SocksRemoteException(
-                    'Failed after {s} retries'.format(s=retry_limit))
+                    'Failed after {s} retries'.format(s=self.retry_limit))
+        if self.metrics is not None:
+            self.metrics.channel_opened(self.name, time.monotonic() - start)
+        self.pool.track(conversation, sp)
         return sp, b'\x01'
 
+    def close(self):
+        if self.warm_cache is not None:
+            self.warm_cache.close()
+        self.pool.close()
+
+
+class SocksMultiSSHRemoteRequestHandler(SocksRemoteRequestHandler):
+    """
+    route each connect to one of several ssh upstreams.
+    upstreams are ranked by smoothed channel open latency divided by
+    smoothed success rate, i.e. expected time to get a channel.
+    a connect failing on one upstream fails over to the next one,
+    an upstream whose ssh transport failed is skipped for cooldown
+    seconds unless every upstream is cooling down. upstreams only
+    retry a dropped conversation retry_limit times, so failing over
+    is not delayed by their own reconnects.
+    a channel refused by the remote is about the destination, not
+    the upstream, so it goes back to the client without failover.
+    """
+    alpha = 0.2
+    cooldown = 30
+    retry_limit = 1
+
+    def __init__(self, upstreams):
+        """
+        upstreams is a list of SocksSSHRemoteRequestHandler
+        """
+        self.upstreams = upstreams
+        for x in upstreams:
+            x.retry_limit = min(x.retry_limit, self.retry_limit)
+        self.latency = [None] * len(upstreams)
+        self.error = [0.0] * len(upstreams)
+        self.down_until = [0] * len(upstreams)
+        self._lock = threading.Lock()
+
+    def score(self, idx):
+        latency = self.latency[idx]
+        if latency is None:
+            return 0  # try unmeasured upstreams first
+        return latency / max(1 - self.error[idx], 0.05)
+
+    def rank(self):
+        now = time.monotonic()
+        with self._lock:
+            order = sorted(range(len(self.upstreams)), key=self.score)
+            up = [i for i in order if self.down_until[i] <= now]
+            down = [i for i in order if self.down_until[i] > now]
+        return up + down
+
+    def record(self, idx, latency=None):
+        '''
+        record a successful open with its latency or a failure
+        '''
+        with self._lock:
+            failed = latency is None
+            self.error[idx] += self.alpha * (failed - self.error[idx])
+            if not failed:
+                if self.latency[idx] is None:
+                    self.latency[idx] = latency
+                else:
+                    self.latency[idx] += self.alpha * (
+                        latency - self.latency[idx])
+            else:
+                self.down_until[idx] = time.monotonic() + self.cooldown
+
+    def routes(self):
+        '''
+        snapshot of upstream statistics
+        '''
+        with self._lock:
+            return [{
+                'remote': '{d}:{p}'.format(d=x.domain, p=x.port),
+                'latency': self.latency[i],
+                'error': self.error[i],
+                'errnum': x.errnum,
+                'reconnectnum': x.reconnectnum,
+                'down': self.down_until[i] > time.monotonic()
+            } for i, x in enumerate(self.upstreams)]
+
+    def connect_handle(self, dst, src, dst_type=b'\x01'):
+        err = None
+        for idx in self.rank():
+            upstream = self.upstreams[idx]
+            start = time.monotonic()
+            try:
+                ret = upstream.connect_handle(dst, src, dst_type)
+            except SocksRemoteRefused:
+                raise
+            except (SocksException, paramiko.SSHException,
+                    socket.error) as e:
+                self.record(idx)
+                err = e
+                continue
+            self.record(idx, time.monotonic() - start)
+            return ret
+        raise SocksRemoteException(
+            'All upstreams failed: {e}'.format(e=err))
+
+    def warm(self):
+        for x in self.upstreams:
+            x.warm()
+
+    def close(self):
+        for x in self.upstreams:
+            x.close()
+
 
 class SocksServer(socketserver.TCPServer):
     def __init__(self,
                  server_address,
                  RequestHandlerClass,
                  TunnelHandler,
-                 bind_and_activate=True):
+                 bind_and_activate=True,
+                 bufsize=RELAY_BUFSIZE,
+                 metrics=None):
         if isinstance(TunnelHandler, SocksRemoteRequestHandler):
             self.socks = TunnelHandler
         else:
             raise SocksRemoteException
+        self.bufsize = bufsize
+        self.metrics = metrics
         try:
             socketserver.TCPServer.__init__(self, server_address,
                                             RequestHandlerClass,
@@ -413,16 +1189,291 @@ class ForkingSocksServer(socketserver.ForkingMixIn, SocksServer):
     pass
 
 
+async def _wait_fd(loop, fd, write=False):
+    """
+        wait until fd is readable (or writable)
+    """
+    fut = loop.create_future()
+
+    def ready():
+        if not fut.done():
+            fut.set_result(None)
+    if write:
+        loop.add_writer(fd, ready)
+    else:
+        loop.add_reader(fd, ready)
+    try:
+        await fut
+    finally:
+        if write:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+async def _peer_recv(loop, peer, size):
+    """
+        recv from a non-blocking socket or ssh channel,
+        channel.fileno() is a pipe which is readable while
+        the channel has buffered data or is closed
+    """
+    while True:
+        try:
+            return peer.recv(size)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            pass
+        await _wait_fd(loop, peer.fileno())
+
+
+async def _peer_sendall(loop, peer, data):
+    """
+        send all data to a non-blocking socket or ssh channel,
+        return False if peer is closed
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            sent = peer.send(view)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            sent = None
+        if sent is None:
+            if isinstance(peer, socket.socket):
+                await _wait_fd(loop, peer.fileno(), write=True)
+            else:
+                # ssh channel window is full, no fd to wait on
+                await asyncio.sleep(0.005)
+        elif sent <= 0:
+            return False
+        else:
+            view = view[sent:]
+    return True
+
+
+class AsyncSocksServer(object):
+    """
+        socks v5 server running on one asyncio event loop,
+        every client is a coroutine instead of a thread.
+        remote sockets and ssh channels returned by
+        TunnelHandler.connect_handle are bridged into the loop,
+        connect_handle itself runs in the loop's executor since
+        opening a ssh channel is blocking.
+        only CONNECT command without authentication is supported.
+    """
+    backlog = 1024
+
+    def __init__(self, server_address, TunnelHandler,
+                 bufsize=RELAY_BUFSIZE, metrics=None):
+        if isinstance(TunnelHandler, SocksRemoteRequestHandler):
+            self.socks = TunnelHandler
+        else:
+            raise SocksRemoteException
+        self.bufsize = bufsize
+        self.metrics = metrics
+        try:
+            self.socket = socket.create_server(server_address,
+                                               backlog=self.backlog)
+        except socket.error as e:
+            if e.errno == 98:
+                print('Address already in use, Socks service start failed')
+            else:
+                print(e)
+            exit()
+        self.server_address = self.socket.getsockname()[:2]
+        self._loop = None
+        self._clients = set()
+        self._stopped = threading.Event()
+
+    def log(self, level, msg):
+        """
+        function to log info
+        """
+        pass  # print level,msg
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_server(self.handle, sock=self.socket))
+            loop.run_forever()
+            server.close()
+            for t in self._clients:
+                t.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*self._clients, return_exceptions=True))
+        finally:
+            loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._stopped.wait()
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._clients.add(task)
+        metrics = self.metrics
+        # bytes relayed from remote and from client, read by metrics
+        conn = types.SimpleNamespace(dst=None, connected=False,
+                                     traffic=[0, 0])
+        if metrics is not None:
+            conn_id = metrics.open_connection(conn)
+        try:
+            await self.handle_socks5(reader, writer, conn)
+        except SocksException as e:
+            self.log('warning', 'SocksException:%s' % e)
+            if metrics is not None and not conn.connected:
+                if isinstance(e, SocksRemoteException):
+                    metrics.connect_failed()
+                else:
+                    metrics.handshake_failed(type(e).__name__)
+        except (asyncio.IncompleteReadError, socket.error) as e:
+            self.log('warning', 'client error:%s' % e)
+            if metrics is not None and not conn.connected:
+                metrics.handshake_failed(type(e).__name__)
+        except asyncio.CancelledError:
+            pass  # server shutdown
+        finally:
+            self._clients.discard(task)
+            writer.close()
+            if metrics is not None:
+                metrics.close_connection(conn_id)
+
+    async def handle_socks5(self, reader, writer, conn):
+        version, nmethod = await reader.readexactly(2)
+        if version != 5:
+            if self.metrics is not None:
+                self.metrics.handshake_failed('version')
+            return
+        methods = await reader.readexactly(nmethod)
+        if 0 not in methods:
+            writer.write(b'\x05\xff')
+            raise SocksIdentifyDisabled(
+                'Just support No authentication required')
+        writer.write(b'\x05\x00')
+        _version, _cmd, _, _atype = await reader.readexactly(4)
+        cmd = bytes([_cmd])
+        atype = bytes([_atype])
+        if atype == b'\x01':  # ipv4
+            addr = socket.inet_ntoa(await reader.readexactly(4))
+        elif atype == b'\x03':  # domain
+            size, = await reader.readexactly(1)
+            addr = (await reader.readexactly(size)).decode()
+        elif atype == b'\x04':  # ipv6
+            addr = socket.inet_ntop(socket.AF_INET6,
+                                    await reader.readexactly(16))
+        else:
+            writer.write(b'\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00')
+            raise SocksAddressTypeDisabled
+        port, = struct.unpack('>H', await reader.readexactly(2))
+        self.log('notify', 'client request:(%s,%d)' % (addr, port))
+        conn.dst = (addr, port)
+        if cmd != b'\x01':  # only connect
+            writer.write(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
+            if self.metrics is not None:
+                self.metrics.handshake_failed('command')
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            remote_sp, remote_atype = await loop.run_in_executor(
+                None, self.socks.connect_handle, (addr, port),
+                writer.get_extra_info('peername')[:2], atype)
+        except SocksRemoteRefused:
+            writer.write(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+            raise
+        except SocksException:
+            remote_sp = None
+        if remote_sp is None:
+            writer.write(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            raise SocksRemoteException('no remote socket')
+        try:
+            bnd_addr, bnd_port = remote_sp.getpeername()[:2]
+            writer.write(socks5_bnd_msg(remote_atype, bnd_addr, bnd_port))
+            conn.connected = True
+            await writer.drain()
+            await self.exchange_data(remote_sp, reader, writer, conn.traffic)
+        finally:
+            remote_sp.close()
+
+    async def exchange_data(self, remote_peer, reader, writer, traffic):
+        """
+            exchange remote socket or ssh channel with socks client
+            until either side closes, counting bytes from remote and
+            from client in traffic
+        """
+        loop = asyncio.get_running_loop()
+        remote_peer.settimeout(0.0)
+
+        async def local_to_remote():
+            while True:
+                data = await reader.read(self.bufsize)
+                if not data:
+                    break
+                traffic[1] += len(data)
+                if not await _peer_sendall(loop, remote_peer, data):
+                    break
+
+        async def remote_to_local():
+            while True:
+                data = await _peer_recv(loop, remote_peer, self.bufsize)
+                if not data:
+                    break
+                traffic[0] += len(data)
+                writer.write(data)
+                await writer.drain()
+
+        tasks = [asyncio.ensure_future(local_to_remote()),
+                 asyncio.ensure_future(remote_to_local())]
+        try:
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t in tasks:
+                t.cancel()
+            # let them unregister the peer fd before it is closed,
+            # the fd number may be reused by another channel
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for t in done:
+            t.result()
+
+
 class SocksOverSSH:
+    '''
+    engine 'thread' serves each client in its own thread,
+    engine 'asyncio' serves all clients on one event loop,
+    connects are spread over pool_size ssh conversations by balance,
+    spare channels are kept open to the warm most frequent destinations.
+    with upstreams, a list of configs as for batch_create, one local
+    listener routes connects over all of them.
+    traffic is counted in self.metrics, with metrics_port it is
+    served on http://local_addr:metrics_port/metrics
+    '''
     def __init__(self, remote_addr, remote_port=22,
                  username=None, keyfile=None,
-                 local_addr='127.0.0.1', local_port=0):
+                 local_addr='127.0.0.1', local_port=0,
+                 engine='thread', bufsize=RELAY_BUFSIZE,
+                 pool_size=1, balance='least', warm=0, upstreams=None,
+                 metrics_port=None):
+        if engine not in ('thread', 'asyncio'):
+            raise ValueError('unknown engine {e}'.format(e=engine))
         self._remote_addr = remote_addr
         self._remote_port = remote_port
         self._username = username
         self._keyfile = keyfile
         self._local_addr = local_addr
         self._local_port = local_port
+        self._engine = engine
+        self._bufsize = bufsize
+        self._pool_size = pool_size
+        self._balance = balance
+        self._warm = warm
+        self._upstreams = upstreams
+        self._metrics_port = metrics_port
+        self._metrics_server = None
+        self.metrics = SocksMetrics()
 
     @classmethod
     def batch_create(cls, configs, run=False):
@@ -430,7 +1481,13 @@ class SocksOverSSH:
             cls(x['remote_addr'], remote_port=x['remote_port'],
                 username=x['username'], keyfile=x['keyfile'],
                 local_addr=x.get('local_addr', '127.0.0.1'),
-                local_port=x.get('local_port', 0)
+                local_port=x.get('local_port', 0),
+                engine=x.get('engine', 'thread'),
+                bufsize=x.get('bufsize', RELAY_BUFSIZE),
+                pool_size=x.get('pool_size', 1),
+                balance=x.get('balance', 'least'),
+                warm=x.get('warm', 0),
+                metrics_port=x.get('metrics_port')
                 ) for x in configs
         ]
         if run:
@@ -438,21 +1495,408 @@ class SocksOverSSH:
                 x.run()
         return ret
 
+    @classmethod
+    def multi_create(cls, configs, local_addr='127.0.0.1', local_port=0,
+                     run=False, **kwargs):
+        ret = cls(None, local_addr=local_addr, local_port=local_port,
+                  upstreams=configs, **kwargs)
+        if run:
+            ret.run()
+        return ret
+
     def get_local_addr(self):
         return self._server.server_address
 
+    def get_metrics_addr(self):
+        if self._metrics_server is None:
+            return None
+        return self._metrics_server.server_address
+
+    def get_tunnel(self):
+        if self._upstreams is None:
+            return SocksSSHRemoteRequestHandler(
+                self._remote_addr, self._username, self._keyfile,
+                self._remote_port,
+                pool_size=self._pool_size, balance=self._balance,
+                warm=self._warm, metrics=self.metrics)
+        return SocksMultiSSHRemoteRequestHandler([
+            SocksSSHRemoteRequestHandler(
+                x['remote_addr'], x['username'], x['keyfile'],
+                x.get('remote_port', 22),
+                pool_size=x.get('pool_size', self._pool_size),
+                balance=x.get('balance', self._balance),
+                warm=x.get('warm', self._warm),
+                metrics=self.metrics
+            ) for x in self._upstreams
+        ])
+
     def run(self):
-        sshtunnel = SocksSSHRemoteRequestHandler(
-            self._remote_addr, self._username, self._keyfile, self._remote_port)
-        self._server = ThreadingSocksServer(
-            (self._local_addr, self._local_port),
-            SocksRequestHandler,
-            sshtunnel
-        )
+        sshtunnel = self.get_tunnel()
+        sshtunnel.warm()
+        if self._engine == 'asyncio':
+            self._server = AsyncSocksServer(
+                (self._local_addr, self._local_port),
+                sshtunnel,
+                bufsize=self._bufsize,
+                metrics=self.metrics
+            )
+        else:
+            self._server = ThreadingSocksServer(
+                (self._local_addr, self._local_port),
+                SocksRequestHandler,
+                sshtunnel,
+                bufsize=self._bufsize,
+                metrics=self.metrics
+            )
+        if self._metrics_port is not None:
+            self._metrics_server = self.metrics.serve(
+                (self._local_addr, self._metrics_port))
         server_thread = threading.Thread(target=self._server.serve_forever)
         server_thread.daemon = True
         server_thread.start()
 
     def stop(self):
         self._server.shutdown()
+        self._server.socks.close()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
         self._server = None
+
+
+def wait_for(cond, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        pass
+
+
+class FakeConversation(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+
+class FakeChannel(object):
+    closed = False
+    eof_received = False
+
+    def close(self):
+        self.closed = True
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(RELAY_BUFSIZE)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+class CopyRequestHandler(SocksRequestHandler):
+    def exchange_data(self, remote_peer, local_peer):
+        self.copy_data(remote_peer, local_peer, self.server.bufsize)
+
+
+class RefusingRemoteRequestHandler(SocksRemoteRequestHandler):
+    def connect_handle(self, dst, src, dst_type=b'\x01'):
+        raise SocksRemoteRefused('Connect failed')
+
+
+class TestRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.echo = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                    EchoHandler)
+        self.echo.daemon_threads = True
+        threading.Thread(target=self.echo.serve_forever).start()
+
+    def tearDown(self):
+        self.echo.shutdown()
+        self.echo.server_close()
+
+    def request(self, server, dst):
+        client = socket.create_connection(server.server_address, 5)
+        client.sendall(b'\x05\x01\x00')
+        self.assertEqual(b'\x05\x00', client.recv(2))
+        client.sendall(b'\x05\x01\x00\x01' + socket.inet_aton(dst[0]) +
+                       struct.pack('>H', dst[1]))
+        return client, client.recv(10)
+
+    def relay(self, server, payload):
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            client, reply = self.request(server, self.echo.server_address)
+            with client:
+                self.assertEqual(b'\x05\x00', reply[:2])
+                sender = threading.Thread(target=client.sendall,
+                                          args=(payload,))
+                sender.start()
+                got = bytearray()
+                while len(got) < len(payload):
+                    data = client.recv(RELAY_BUFSIZE)
+                    if not data:
+                        break
+                    got += data
+                sender.join()
+            return bytes(got)
+        finally:
+            server.shutdown()
+
+    def test_threading(self):
+        payload = os.urandom(1 << 20)
+        for handler in [SocksRequestHandler, CopyRequestHandler]:
+            server = ThreadingSocksServer(('127.0.0.1', 0), handler,
+                                          SocksRemoteRequestHandler(),
+                                          bufsize=4096)
+            self.assertEqual(payload, self.relay(server, payload))
+            server.server_close()
+
+    def test_asyncio(self):
+        payload = os.urandom(1 << 20)
+        server = AsyncSocksServer(('127.0.0.1', 0),
+                                  SocksRemoteRequestHandler(), bufsize=4096)
+        self.assertEqual(payload, self.relay(server, payload))
+        server.socket.close()
+
+    def test_refused(self):
+        for server in [
+                ThreadingSocksServer(('127.0.0.1', 0), SocksRequestHandler,
+                                     RefusingRemoteRequestHandler()),
+                AsyncSocksServer(('127.0.0.1', 0),
+                                 RefusingRemoteRequestHandler())]:
+            threading.Thread(target=server.serve_forever).start()
+            try:
+                client, reply = self.request(server, ('127.0.0.1', 1))
+                client.close()
+                self.assertEqual(b'\x05\x05', reply[:2])
+            finally:
+                server.shutdown()
+                if isinstance(server, SocksServer):
+                    server.server_close()
+                else:
+                    server.socket.close()
+
+
+class TestSSHTransportPool(unittest.TestCase):
+
+    def setUp(self):
+        self.up = True
+        self.made = []
+
+    def factory(self):
+        if not self.up:
+            raise SocksRemoteException('Timeout connecting to remote server')
+        self.made.append(FakeConversation())
+        return self.made[-1]
+
+    def alive(self, pool):
+        return sum(pool.alive(x) for x in pool._slots)
+
+    def test_balance(self):
+        pool = SSHTransportPool(self.factory, 3, 'round')
+        pool.get()
+        self.assertTrue(wait_for(lambda: self.alive(pool) == 3))
+        got = [pool.get() for _ in range(6)]
+        self.assertEqual(3, len(set(got)))
+        self.assertEqual(got[:3], got[3:])
+        pool = SSHTransportPool(self.factory, 3, 'least')
+        pool.fill()
+        self.assertTrue(wait_for(lambda: self.alive(pool) == 3))
+        channels = [FakeChannel() for _ in range(6)]
+        for x in channels:
+            pool.track(pool.get(), x)
+        self.assertEqual([2, 2, 2],
+                         [pool._open_channels(i) for i in range(3)])
+        self.assertRaises(ValueError, SSHTransportPool, self.factory,
+                          balance='random')
+
+    def test_replace_unreachable(self):
+        pool = SSHTransportPool(self.factory, 2)
+        pool.retry_delay = 0.2
+        pool.fill()
+        self.assertTrue(wait_for(lambda: self.alive(pool) == 2))
+        self.up = False
+        pool.retire(pool.get())
+        self.assertTrue(wait_for(lambda: not pool._replacing))
+        self.assertEqual(1, self.alive(pool))
+        self.up = True
+        pool.get()  # still in retry_delay
+        self.assertEqual(1, self.alive(pool))
+        time.sleep(0.2)
+        pool.get()
+        self.assertTrue(wait_for(lambda: self.alive(pool) == 2))
+        pool.close()
+        self.assertEqual(0, self.alive(pool))
+
+
+class TestWarmChannelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+
+    def opener(self, dst):
+        self.opened.append(FakeChannel())
+        return self.opened[-1]
+
+    def test_min_count(self):
+        cache = WarmChannelCache(self.opener, hot=2, min_count=3)
+        for dst in ['a', 'b', 'c', 'a', 'a']:
+            self.assertIsNone(cache.get(dst))
+        self.assertTrue(wait_for(lambda: len(self.opened) == 1))
+        self.assertIs(self.opened[0], cache.get('a'))
+        self.assertTrue(wait_for(lambda: len(self.opened) == 2))
+        for dst in ['b', 'c']:
+            cache.get(dst)
+        time.sleep(0.1)
+        self.assertEqual(2, len(self.opened))
+        cache.close()
+        self.assertTrue(self.opened[1].closed)
+
+    def test_reaper(self):
+        cache = WarmChannelCache(self.opener, max_age=0.1, min_count=1)
+        cache.get('a')
+        self.assertTrue(wait_for(lambda: len(self.opened) == 1))
+        self.assertTrue(wait_for(lambda: self.opened[0].closed))
+        self.assertEqual({}, cache._spares)
+        cache.get('a')
+        self.assertTrue(wait_for(lambda: len(self.opened) == 2))
+        self.opened[1].closed = True
+        self.assertIsNone(cache.get('a'))
+        cache.close()
+
+
+class StubUpstream(SocksRemoteRequestHandler):
+    errnum = 0
+    reconnectnum = 0
+    retry_limit = 5
+
+    def __init__(self, domain, delay=0, error=None):
+        self.domain = domain
+        self.port = 22
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def connect_handle(self, dst, src, dst_type=b'\x01'):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return FakeChannel(), b'\x01'
+
+
+class TestMultiSSHRemote(unittest.TestCase):
+
+    def connect(self, multi):
+        return multi.connect_handle(('127.0.0.1', 80), ('127.0.0.1', 1))
+
+    def test_rank(self):
+        slow = StubUpstream('slow', delay=0.05)
+        fast = StubUpstream('fast')
+        multi = SocksMultiSSHRemoteRequestHandler([slow, fast])
+        self.assertEqual(1, slow.retry_limit)
+        for _ in range(4):
+            self.connect(multi)
+        self.assertEqual([1, 0], multi.rank())
+        self.assertEqual((1, 3), (slow.calls, fast.calls))
+        self.assertEqual(['slow:22', 'fast:22'],
+                         [x['remote'] for x in multi.routes()])
+
+    def test_failover(self):
+        down = StubUpstream('down', error=SocksRemoteException('timeout'))
+        up = StubUpstream('up', delay=0.01)
+        multi = SocksMultiSSHRemoteRequestHandler([down, up])
+        self.connect(multi)
+        self.assertTrue(multi.routes()[0]['down'])
+        self.assertGreater(multi.routes()[0]['error'], 0)
+        self.connect(multi)
+        self.assertEqual((1, 2), (down.calls, up.calls))
+        up.error = socket.error('unreachable')
+        with self.assertRaises(SocksRemoteException):
+            self.connect(multi)
+        self.assertEqual((2, 3), (down.calls, up.calls))
+
+    def test_refused(self):
+        refusing = StubUpstream('refusing',
+                                error=SocksRemoteRefused('Connect failed'))
+        other = StubUpstream('other', delay=0.01)
+        multi = SocksMultiSSHRemoteRequestHandler([refusing, other])
+        with self.assertRaises(SocksRemoteRefused):
+            self.connect(multi)
+        self.assertEqual((1, 0), (refusing.calls, other.calls))
+        self.assertEqual(0, multi.routes()[0]['error'])
+        self.assertFalse(multi.routes()[0]['down'])
+
+
+class TestSocksMetrics(unittest.TestCase):
+
+    def test_render(self):
+        metrics = SocksMetrics()
+        metrics.max_destinations = 1
+        done = types.SimpleNamespace(dst=('a', 80), traffic=[0, 0])
+        metrics.close_connection(metrics.open_connection(done))
+        conn = types.SimpleNamespace(dst=None, traffic=[0, 0])
+        conn_id = metrics.open_connection(conn)
+        conn.dst = ('b"\\', 443)
+        conn.traffic[0] += 100
+        conn.traffic[1] += 20
+        metrics.handshake_failed('version')
+        metrics.channel_opened('h:22', 0.02)
+        metrics.channel_opened('h:22', 3)
+        metrics.refused('h:22')
+        lines = metrics.render().splitlines()
+        for line in [
+                'g4z3_socks_connections_total 2',
+                'g4z3_socks_active_connections 1',
+                'g4z3_socks_bytes_total{direction="in"} 100',
+                'g4z3_socks_connection_bytes_total{connection="2",'
+                'destination="other",direction="out"} 20',
+                'g4z3_socks_destination_bytes_total{destination="a:80",'
+                'direction="in"} 0',
+                'g4z3_socks_destination_bytes_total{destination="other",'
+                'direction="in"} 100',
+                'g4z3_socks_handshake_failures_total{reason="version"} 1',
+                'g4z3_ssh_channel_open_seconds_bucket{le="0.025",'
+                'upstream="h:22"} 1',
+                'g4z3_ssh_channel_open_seconds_bucket{le="+Inf",'
+                'upstream="h:22"} 2',
+                'g4z3_ssh_channel_open_seconds_count{upstream="h:22"} 2',
+                'g4z3_ssh_channel_refused_total{upstream="h:22"} 1']:
+            self.assertIn(line, lines)
+        self.assertIn('# TYPE g4z3_socks_bytes_total counter', lines)
+        metrics.max_destinations = 256
+        lines = metrics.render().splitlines()
+        self.assertIn('g4z3_socks_connection_bytes_total{connection="2",'
+                      'destination="b\\"\\\\:443",direction="in"} 100',
+                      lines)
+        conn.traffic[1] += 5
+        metrics.close_connection(conn_id)
+        lines = metrics.render().splitlines()
+        self.assertIn('g4z3_socks_active_connections 0', lines)
+        self.assertIn('g4z3_socks_bytes_total{direction="out"} 25', lines)
+        self.assertFalse([x for x in lines if x.startswith(
+            'g4z3_socks_connection_bytes_total{')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,10 +2,20 @@
 import subprocess
 import requests
 import json
+import math
 import time
 import os
+import socket
+import struct
+import sys
 import argparse
-import functools
+import http.server
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from watcher import Watcher
 
 
@@ -19,41 +29,228 @@ TEST_URLS = [
 ]
 
 
+METRICS = ('connect', 'ttfb', 'total', 'throughput')
+
+
+def percentile(values, q):
+    '''
+    nearest rank percentile, None for no values
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(values):
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95)}
+
+
+def socks_connect_time(proxy_port, url, timeout):
+    '''
+    seconds for the socks5 proxy to connect to the host of url
+    '''
+    u = urllib.parse.urlsplit(url)
+    port = u.port or (443 if u.scheme == 'https' else 80)
+    try:
+        dst = b'\x01' + socket.inet_aton(u.hostname)
+    except OSError:
+        host = u.hostname.encode('idna')
+        dst = b'\x03' + bytes([len(host)]) + host
+    start = time.perf_counter()
+    s = socket.create_connection(('127.0.0.1', proxy_port), timeout)
+    try:
+        s.sendall(b'\x05\x01\x00')
+        if s.recv(2) != b'\x05\x00':
+            raise OSError('socks handshake failed')
+        s.sendall(b'\x05\x01\x00' + dst + struct.pack('>H', port))
+        reply = s.recv(512)
+        if len(reply) < 2 or reply[1] != 0:
+            raise OSError('socks connect failed')
+        return time.perf_counter() - start
+    finally:
+        s.close()
+
+
 class SSChecker(object):
+    '''
+    check up to workers servers at once, each sslocal listens on its
+    own free local port, urls of a server are fetched concurrently
+    and every fetch gives up after timeout seconds.
+    every url is fetched samples times measuring socks connect time,
+    time to first byte, total time and throughput, summarized as
+    p50/p95. payload_url is fetched the same way to measure
+    throughput on a larger download.
+    a working server is degraded if some samples failed, its p95 time
+    to first byte is above max_ttfb or its p50 payload throughput in
+    bytes/s is below min_throughput.
+    '''
 
-    def __init__(self, config_dir, test_urls):
+    def __init__(self, config_dir, test_urls, workers=8, timeout=10,
+                 startup_timeout=10, samples=3, payload_url=None,
+                 max_ttfb=None, min_throughput=None):
         self._config_dir = config_dir
         self._test_urls = test_urls
+        self._workers = workers
+        self._timeout = timeout
+        self._startup_timeout = startup_timeout
+        self._samples = samples
+        self._payload_url = payload_url
+        self._max_ttfb = max_ttfb
+        self._min_throughput = min_throughput
+        self.last_result = None
 
-    def _check_server(self, config_path):
-        p = subprocess.Popen(['sslocal', '-c', config_path])
-        time.sleep(3)
-        c = json.load(open(config_path))
-        local_port = c.get('local_port', 1080)
-        proxies = {
-            'http': 'socks5h://127.0.0.1:' + str(local_port),
-            'https': 'socks5h://127.0.0.1:' + str(local_port)
+    @staticmethod
+    def _free_port():
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def _wait_port(self, p, port):
+        deadline = time.monotonic() + self._startup_timeout
+        while time.monotonic() < deadline:
+            if p.poll() is not None:
+                return False
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return True
+            except OSError:
+                time.sleep(0.05)
+        return False
+
+    def _sample_url(self, u, proxies, local_port):
+        '''
+        one timed fetch of u, None if it failed
+        '''
+        try:
+            connect = socks_connect_time(local_port, u, self._timeout)
+            start = time.perf_counter()
+            with requests.get(u, proxies=proxies, verify=False,
+                              timeout=self._timeout, stream=True) as resp:
+                ttfb = time.perf_counter() - start
+                size = 0
+                for chunk in resp.iter_content(65536):
+                    size += len(chunk)
+                total = time.perf_counter() - start
+                if not resp.ok:
+                    return None
+        except (requests.RequestException, OSError):
+            return None
+        return {
+            'connect': connect,
+            'ttfb': ttfb,
+            'total': total,
+            'throughput': size / (total - ttfb) if total > ttfb else None
         }
+
+    def _check_url(self, u, proxies, local_port):
+        print("testing url {u}".format(u=u))
+        samples = [self._sample_url(u, proxies, local_port)
+                   for _ in range(self._samples)]
+        samples = [x for x in samples if x is not None]
+        ret = {'ok': len(samples) > 0, 'samples': len(samples)}
+        for k in METRICS:
+            ret[k] = summarize([x[k] for x in samples if x[k] is not None])
+        return ret
+
+    def _urls(self):
+        if self._payload_url is None:
+            return self._test_urls
+        return self._test_urls + [self._payload_url]
+
+    def _check_server(self, config_path):
+        urls = self._urls()
+        local_port = self._free_port()
+        p = subprocess.Popen(['sslocal', '-c', config_path,
+                              '-l', str(local_port)])
+        try:
+            if not self._wait_port(p, local_port):
+                failed = {'ok': False, 'samples': 0}
+                failed.update({k: summarize([]) for k in METRICS})
+                return {u: failed for u in urls}
+            proxies = {
+                'http': 'socks5h://127.0.0.1:' + str(local_port),
+                'https': 'socks5h://127.0.0.1:' + str(local_port)
+            }
+            with ThreadPoolExecutor(max(len(urls), 1)) as pool:
+                rets = pool.map(
+                    lambda u: self._check_url(u, proxies, local_port), urls)
+                return dict(zip(urls, rets))
+        finally:
+            p.kill()
+            p.wait()
+
+    def _degraded(self, urls):
+        for u, ret in urls.items():
+            if ret['samples'] < self._samples:
+                return True
+            ttfb = ret['ttfb']['p95']
+            if self._max_ttfb is not None and ttfb > self._max_ttfb:
+                return True
+        payload = urls.get(self._payload_url)
+        if payload is not None and self._min_throughput is not None:
+            throughput = payload['throughput']['p50']
+            if throughput is None or throughput < self._min_throughput:
+                return True
+        return False
+
+    def check(self):
+        '''
+        measure every server, return
+        {config: {'ok': bool, 'degraded': bool, 'urls': {url: metrics}}}
+        '''
         ret = {}
-        for u in self._test_urls:
-            try:
-                print("testing url {u}".format(u=u))
-                resp = requests.get(u, proxies=proxies, verify=False)
-                ret[u] = resp.ok
-            except:
-                ret[u] = False
-        p.kill()
+        configs = os.listdir(self._config_dir)
+        with ThreadPoolExecutor(self._workers) as pool:
+            rets = pool.map(
+                lambda x: self._check_server(
+                    os.path.join(self._config_dir, x)),
+                configs)
+            for x, urls in zip(configs, rets):
+                ok = all(u['ok'] for u in urls.values())
+                ret[x] = {
+                    'ok': ok,
+                    'degraded': ok and self._degraded(urls),
+                    'urls': urls
+                }
+        self.last_result = ret
+        return ret
+
+    def state(self):
+        '''
+        {config: {'status': 'OK'|'DEGRADED'|'ERROR', 'urls': {url: ok}}}
+        for incremental watching
+        '''
+        ret = {}
+        for x, r in self.check().items():
+            if not r['ok']:
+                status = 'ERROR'
+            elif r['degraded']:
+                status = 'DEGRADED'
+            else:
+                status = 'OK'
+            ret[x] = {
+                'status': status,
+                'urls': {u: m['ok'] for u, m in r['urls'].items()}
+            }
         return ret
 
     def do(self):
+        result = self.check()
         msgs = []
-        all_pass = True
-        for x in os.listdir(self._config_dir):
+        for x, ret in result.items():
             msgs.append(x)
-            ret = self._check_server(os.path.join(self._config_dir, x))
-            msgs.append(json.dumps(ret, ensure_ascii=False, indent=4))
-            all_pass = all_pass and functools.reduce(lambda x, y: x and y, ret.values())
-        subject = "SS OK" if all_pass else "SS ERROR!!!"
+            oks = {u: m['ok'] for u, m in ret['urls'].items()}
+            msgs.append(json.dumps(oks, ensure_ascii=False, indent=4))
+        msgs.append(json.dumps(result, ensure_ascii=False, indent=4))
+        if not all(x['ok'] for x in result.values()):
+            subject = "SS ERROR!!!"
+        elif any(x['degraded'] for x in result.values()):
+            subject = "SS DEGRADED"
+        else:
+            subject = "SS OK"
         msg = '\n\n'.join(msgs)
         return subject, msg
 
@@ -63,11 +260,205 @@ def run():
     parser.add_argument("config", help="watch's own config file path")
     parser.add_argument("config_dir", help="ss local config files directory")
     parser.add_argument("interval", help="report interval, in minutes")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="servers checked at once")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="timeout of each url fetch, in seconds")
+    parser.add_argument("--samples", type=int, default=3,
+                        help="fetches of each url")
+    parser.add_argument("--payload-url",
+                        help="larger download to measure throughput on")
+    parser.add_argument("--max-ttfb", type=float,
+                        help="p95 time to first byte above which a server "
+                             "is degraded, in seconds")
+    parser.add_argument("--min-throughput", type=float,
+                        help="p50 payload throughput below which a server "
+                             "is degraded, in bytes/s")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only report state changes")
+    parser.add_argument("--heartbeat", type=float,
+                        help="report without changes every heartbeat "
+                             "minutes in incremental mode")
     args = parser.parse_args()
-    checker = SSChecker(args.config_dir, TEST_URLS)
-    m = Watcher(checker, int(args.interval) * 60, args.config)
+    checker = SSChecker(args.config_dir, TEST_URLS,
+                        workers=args.workers, timeout=args.timeout,
+                        samples=args.samples, payload_url=args.payload_url,
+                        max_ttfb=args.max_ttfb,
+                        min_throughput=args.min_throughput)
+    m = Watcher(None, None, args.config)
+    m.add(checker, int(args.interval) * 60, incremental=args.incremental,
+          heartbeat=args.heartbeat * 60 if args.heartbeat else None)
     m.run()
 
 
+FAKE_SSLOCAL = """#!{python}
+import json, sys, time
+sys.path.insert(0, {path!r})
+import socks_over_ssh
+args = sys.argv[1:]
+port = int(args[args.index('-l') + 1])
+with open(args[args.index('-c') + 1]) as f:
+    config = json.load(f)
+time.sleep(config.get('startup', 0))
+if config.get('dead'):
+    sys.exit(1)
+server = socks_over_ssh.ThreadingSocksServer(
+    ('127.0.0.1', port), socks_over_ssh.SocksRequestHandler,
+    socks_over_ssh.SocksRemoteRequestHandler())
+server.serve_forever()
+"""
+
+
+class FakeHTTPHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if self.path == '/slow':
+            time.sleep(0.3)
+        body = b'x' * (1 << 20 if self.path == '/big' else 100)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSSChecker(unittest.TestCase):
+    '''
+    servers are a fake sslocal on PATH, a local socks server that
+    starts after the startup seconds of its config or exits if dead
+    '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config_dir = os.path.join(self.dir, 'configs')
+        os.mkdir(self.config_dir)
+        sslocal = os.path.join(self.dir, 'sslocal')
+        with open(sslocal, 'w') as f:
+            f.write(FAKE_SSLOCAL.format(
+                python=sys.executable,
+                path=os.path.dirname(os.path.abspath(__file__))))
+        os.chmod(sslocal, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.dir + os.pathsep + self.path
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     FakeHTTPHandler)
+        threading.Thread(target=self.httpd.serve_forever).start()
+        self.base = 'http://127.0.0.1:{p}'.format(
+            p=self.httpd.server_address[1])
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.dir)
+
+    def server(self, name, **config):
+        with open(os.path.join(self.config_dir, name), 'w') as f:
+            json.dump(config, f)
+
+    def test_check(self):
+        for i in range(3):
+            self.server('s{i}.json'.format(i=i), startup=1.5)
+        self.server('dead.json', dead=True)
+        urls = [self.base + '/a', self.base + '/slow']
+        checker = SSChecker(self.config_dir, urls, workers=4, samples=1)
+        start = time.monotonic()
+        ret = checker.check()
+        self.assertLess(time.monotonic() - start, 4)  # not one by one
+        self.assertEqual(['dead.json', 's0.json', 's1.json', 's2.json'],
+                         sorted(ret))
+        self.assertFalse(ret['dead.json']['ok'])
+        self.assertEqual(0, ret['dead.json']['urls'][urls[0]]['samples'])
+        for x in ['s0.json', 's1.json', 's2.json']:
+            self.assertTrue(ret[x]['ok'])
+            self.assertEqual(urls, list(ret[x]['urls']))
+
+    def test_wait_port(self):
+        self.server('late.json', startup=5)
+        checker = SSChecker(self.config_dir, [self.base + '/a'],
+                            startup_timeout=0.5)
+        start = time.monotonic()
+        self.assertFalse(checker.check()['late.json']['ok'])
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_no_urls(self):
+        self.server('s.json')
+        ret = SSChecker(self.config_dir, []).check()
+        self.assertEqual({'ok': True, 'degraded': False, 'urls': {}},
+                         ret['s.json'])
+
+    def test_metrics(self):
+        self.server('s.json')
+        urls = [self.base + '/a', self.base + '/missing']
+        checker = SSChecker(self.config_dir, urls, samples=2,
+                            payload_url=self.base + '/big')
+        ret = checker.check()['s.json']
+        self.assertFalse(ret['ok'])
+        self.assertEqual(0, ret['urls'][urls[1]]['samples'])
+        self.assertEqual({'p50': None, 'p95': None},
+                         ret['urls'][urls[1]]['ttfb'])
+        for u in [urls[0], self.base + '/big']:
+            m = ret['urls'][u]
+            self.assertEqual(2, m['samples'])
+            self.assertGreater(m['connect']['p50'], 0)
+            self.assertLessEqual(m['ttfb']['p95'], m['total']['p95'])
+        self.assertIsNotNone(
+            ret['urls'][self.base + '/big']['throughput']['p50'])
+
+    def test_socks_connect_time(self):
+        self.server('s.json')
+        port = SSChecker._free_port()
+        p = subprocess.Popen(['sslocal', '-c',
+                              os.path.join(self.config_dir, 's.json'),
+                              '-l', str(port)])
+        try:
+            self.assertTrue(SSChecker(self.config_dir, [])._wait_port(
+                p, port))
+            self.assertGreater(
+                socks_connect_time(port, self.base + '/a', 2), 0)
+            self.assertGreater(socks_connect_time(
+                port, self.base.replace('127.0.0.1', 'localhost'), 2), 0)
+            with self.assertRaises(OSError):
+                socks_connect_time(port, 'http://127.0.0.1:1/', 2)
+        finally:
+            p.kill()
+            p.wait()
+
+
+class TestDegraded(unittest.TestCase):
+
+    def test_summarize(self):
+        self.assertIsNone(percentile([], 50))
+        values = list(range(10, 0, -1))
+        self.assertEqual(5, percentile(values, 50))
+        self.assertEqual(10, percentile(values, 95))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual({'p50': 2, 'p95': 2}, summarize([2]))
+
+    def metrics(self, samples=3, ttfb=0.1, throughput=None):
+        return {'samples': samples, 'ttfb': summarize([ttfb]),
+                'throughput': summarize([throughput] if throughput else [])}
+
+    def test_degraded(self):
+        checker = SSChecker(None, ['a'], samples=3, payload_url='big',
+                            max_ttfb=1, min_throughput=1000)
+        ok = {'a': self.metrics(), 'big': self.metrics(throughput=2000)}
+        self.assertFalse(checker._degraded(ok))
+        for u, metrics in [('a', self.metrics(samples=2)),
+                           ('a', self.metrics(ttfb=2)),
+                           ('big', self.metrics(throughput=500)),
+                           ('big', self.metrics())]:
+            urls = dict(ok)
+            urls[u] = metrics
+            self.assertTrue(checker._degraded(urls))
+        checker = SSChecker(None, ['a'], samples=3)
+        self.assertFalse(checker._degraded(
+            {'a': self.metrics(ttfb=2)}))
+
+
 if __name__ == '__main__':
     run()
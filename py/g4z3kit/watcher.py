@@ -1,17 +1,43 @@
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+import collections
 import json
+import re
 import sched
+import socketserver
+import tempfile
+import threading
 import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 
 class MsgSender(object):
-    def __init__(self, accnt, passwd, server, port):
+    '''
+    keep one logged in smtp session across sends,
+    reconnect once when the server has dropped it
+    '''
+    def __init__(self, accnt, passwd, server, port, tls=True):
         self._accnt = accnt
         self._passwd = passwd
         self._server = server
         self._port = port
+        self._tls = tls
+        self._mailserver = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        mailserver = smtplib.SMTP(self._server, self._port)
+        # identify ourselves to smtp gmail client
+        mailserver.ehlo()
+        if self._tls:
+            # secure our email with tls encryption
+            mailserver.starttls()
+            # re-identify ourselves as an encrypted connection
+            mailserver.ehlo()
+        mailserver.login(self._accnt, self._passwd)
+        return mailserver
 
     def send(self, dst, subject, content):
         msg = MIMEMultipart()
@@ -19,16 +45,131 @@ class MsgSender(object):
         msg['To'] = dst
         msg['Subject'] = subject
         msg.attach(MIMEText(content))
-        mailserver = smtplib.SMTP(self._server, self._port)
-        # identify ourselves to smtp gmail client
-        mailserver.ehlo()
-        # secure our email with tls encryption
-        mailserver.starttls()
-        # re-identify ourselves as an encrypted connection
-        mailserver.ehlo()
-        mailserver.login(self._accnt, self._passwd)
-        mailserver.sendmail(self._accnt, dst, msg.as_string())
-        mailserver.quit()
+        with self._lock:
+            if self._mailserver is None:
+                self._mailserver = self._connect()
+            try:
+                self._mailserver.sendmail(self._accnt, dst, msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                self._mailserver = self._connect()
+                self._mailserver.sendmail(self._accnt, dst, msg.as_string())
+
+    def close(self):
+        with self._lock:
+            if self._mailserver is None:
+                return
+            try:
+                self._mailserver.quit()
+            except smtplib.SMTPException:
+                pass
+            self._mailserver = None
+
+
+class MsgQueue(object):
+    '''
+    coalesce messages put within window seconds into one digest
+    mail per receiver, sent by a background thread over one sender.
+    the window opens with the first pending message.
+    messages that failed to send stay pending and are retried after
+    retry_delay seconds, doubling up to max_retry_delay.
+    '''
+    retry_delay = 5
+    max_retry_delay = 600
+
+    def __init__(self, sender, window=60):
+        self._sender = sender
+        self._window = window
+        self._pending = collections.OrderedDict()
+        self._deadline = None
+        self._delay = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, dst, subject, content):
+        with self._cond:
+            if not self._pending:
+                self._deadline = time.monotonic() + self._window
+            self._pending.setdefault(dst, []).append((subject, content))
+            self._cond.notify()
+
+    def flush(self):
+        '''
+        send pending messages now. on failure the unsent ones are put
+        back in front of those put meanwhile and the error is raised
+        '''
+        with self._cond:
+            unsent = list(self._pending.items())
+            self._pending = collections.OrderedDict()
+        try:
+            while unsent:
+                dst, msgs = unsent[0]
+                self._sender.send(dst, *self.digest(msgs))
+                unsent.pop(0)
+        finally:
+            if unsent:
+                with self._cond:
+                    pending = collections.OrderedDict(unsent)
+                    for dst, msgs in self._pending.items():
+                        pending.setdefault(dst, []).extend(msgs)
+                    self._pending = pending
+
+    def pending(self):
+        with self._cond:
+            return sum(len(x) for x in self._pending.values())
+
+    def close(self):
+        '''
+        stop the thread and send what is pending. if that fails the
+        error is raised and the messages stay pending for flush()
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        try:
+            self.flush()
+        finally:
+            self._sender.close()
+
+    @staticmethod
+    def digest(msgs):
+        if len(msgs) == 1:
+            return msgs[0]
+        subjects = []
+        for subject, _ in msgs:
+            if subject not in subjects:
+                subjects.append(subject)
+        subject = '[{n} messages] {s}'.format(n=len(msgs),
+                                              s=' / '.join(subjects))
+        content = '\n\n'.join(
+            '==== {s} ====\n{c}'.format(s=s, c=c) for s, c in msgs)
+        return subject, content
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (
+                        not self._pending or
+                        time.monotonic() < self._deadline):
+                    timeout = None
+                    if self._pending:
+                        timeout = self._deadline - time.monotonic()
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                self._delay = None
+            except (smtplib.SMTPException, OSError) as e:
+                self._delay = self.retry_delay if self._delay is None \
+                    else min(self._delay * 2, self.max_retry_delay)
+                print("sending msg failed: {e}, retry in {d}s".format(
+                    e=e, d=self._delay))
+                with self._cond:
+                    self._deadline = time.monotonic() + self._delay
 
 
 def test_msgsender():
@@ -36,26 +177,443 @@ def test_msgsender():
     sender.send('kiwi@mini-monster.net', 'greeting from python', 'hahahaha')
 
 
+def diff(old, new, path=()):
+    '''
+    structural diff of nested dicts,
+    return {path: (old, new)} for every changed leaf
+    '''
+    if isinstance(old, dict) and isinstance(new, dict):
+        ret = {}
+        for k in list(old) + [x for x in new if x not in old]:
+            ret.update(diff(old.get(k), new.get(k), path + (k,)))
+        return ret
+    if old == new:
+        return {}
+    return {path: (old, new)}
+
+
+class WatchJob(object):
+    '''
+    an incremental job reports only changes of collector.state(),
+    a nested dict of states, plus a heartbeat every heartbeat seconds
+    without changes. a state changing flap_count times within
+    flap_window seconds is reported as flapping.
+    '''
+    def __init__(self, collector, interval, overrun, incremental=False,
+                 heartbeat=None, flap_window=3600, flap_count=4):
+        if overrun not in ('skip', 'queue', 'parallel'):
+            raise ValueError('unknown overrun {o}'.format(o=overrun))
+        self.collector = collector
+        self.interval = interval
+        self.overrun = overrun
+        self.incremental = incremental
+        self.heartbeat = heartbeat
+        self.flap_window = flap_window
+        self.flap_count = flap_count
+        self.running = 0
+        self.pending = False
+        self.state = None
+        self.last_sent = None
+        self.history = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+
+    def update(self, state, now):
+        '''
+        take a new state, return (subject, msg) to send or None
+        '''
+        with self.lock:
+            old = self.state
+            self.state = state
+            if old is None:
+                self.last_sent = now
+                return 'INITIAL STATE', json.dumps(
+                    state, ensure_ascii=False, indent=4)
+            changes = diff(old, state)
+            flapping = []
+            for path in changes:
+                history = self.history[path]
+                history.append(now)
+                while history and history[0] < now - self.flap_window:
+                    history.popleft()
+                if len(history) >= self.flap_count:
+                    flapping.append(path)
+            if not changes:
+                if (self.heartbeat is None or
+                        now - self.last_sent < self.heartbeat):
+                    return None
+                self.last_sent = now
+                return 'HEARTBEAT', 'no change'
+            self.last_sent = now
+        lines = []
+        for path, (a, b) in changes.items():
+            lines.append('{p}: {a} -> {b}{f}'.format(
+                p='/'.join(str(x) for x in path), a=a, b=b,
+                f=' (flapping)' if path in flapping else ''))
+        subject = 'CHANGED: ' + lines[0] if len(lines) == 1 else \
+            'CHANGED: {n} states'.format(n=len(lines))
+        if flapping:
+            subject = 'FLAPPING ' + subject
+        return subject, '\n'.join(lines)
+
+
 class Watcher(object):
-    def __init__(self, collector, interval, config_path):
-        self._scheduler = sched.scheduler(time.time, time.sleep)
-        self._interval = interval
-        self._collector = collector
+    '''
+    run every added collector each its own interval on a thread pool,
+    so a slow collector does not delay the others.
+    ticks are planned on the monotonic clock at fixed offsets from the
+    start, so they neither drift nor jump with wall time.
+    overrun decides what a tick does while the previous run of the
+    same collector is still going:
+        'skip'      drop the tick
+        'queue'     run once more right after the current run
+        'parallel'  run anyway
+    '''
+    def __init__(self, collector, interval, config_path, overrun='skip',
+                 workers=None):
+        # waits in the scheduler end early once stop() sets this
+        self._wakeup = threading.Event()
+        self._scheduler = sched.scheduler(time.monotonic, self._wakeup.wait)
+        self._jobs = []
+        self._workers = workers
+        self._pool = None
+        self._stopped = False
         self._config = json.load(open(config_path))
-
-    def collect(self):
-        subject, msg = self._collector.do()
         sender = MsgSender(
             self._config['ME_ACCOUNT'],
             self._config['ME_PASSWORD'],
             self._config['ME_SERVER'],
-            self._config['ME_PORT']
+            self._config['ME_PORT'],
+            self._config.get('ME_TLS', True)
         )
-        print("sending msg")
-        sender.send(self._config['THEM_ACCOUNT'], subject, msg)
-        print("msg sent")
-        self._scheduler.enter(self._interval, 1, self.collect)
+        self._queue = MsgQueue(sender, self._config.get('DIGEST_WINDOW', 0))
+        if collector is not None:
+            self.add(collector, interval, overrun)
+
+    def add(self, collector, interval, overrun='skip', **kwargs):
+        '''
+        kwargs are the incremental options of WatchJob
+        '''
+        job = WatchJob(collector, interval, overrun, **kwargs)
+        self._jobs.append(job)
+        return job
+
+    def report(self, job):
+        if job.incremental:
+            ret = job.update(job.collector.state(), time.monotonic())
+            if ret is None:
+                return
+            subject, msg = ret
+        else:
+            subject, msg = job.collector.do()
+        print("queueing msg")
+        self._queue.put(self._config['THEM_ACCOUNT'], subject, msg)
+
+    def collect(self):
+        '''
+        run every collector once, in this thread
+        '''
+        for job in self._jobs:
+            self.report(job)
+
+    def _run_job(self, job):
+        while True:
+            try:
+                self.report(job)
+            except Exception as e:
+                print("collector {c} failed: {e!r}".format(
+                    c=job.collector, e=e))
+            with job.lock:
+                if job.pending:
+                    job.pending = False
+                    continue
+                job.running -= 1
+                return
+
+    def _tick(self, job, due):
+        if self._stopped:
+            return
+        self._scheduler.enterabs(due + job.interval, 1, self._tick,
+                                 (job, due + job.interval))
+        with job.lock:
+            if job.running and job.overrun == 'skip':
+                return
+            if job.running and job.overrun == 'queue':
+                job.pending = True
+                return
+            job.running += 1
+        self._pool.submit(self._run_job, job)
 
     def run(self):
-        self.collect()
-        self._scheduler.run()
+        self._pool = ThreadPoolExecutor(self._workers)
+        now = time.monotonic()
+        for job in self._jobs:
+            self._scheduler.enterabs(now, 1, self._tick, (job, now))
+        try:
+            self._scheduler.run()
+        finally:
+            self._pool.shutdown()
+            self._queue.close()
+
+    def stop(self):
+        '''
+        stop scheduling ticks, run() returns once running
+        collectors finished and queued messages are sent
+        '''
+        self._stopped = True
+        for event in self._scheduler.queue:
+            try:
+                self._scheduler.cancel(event)
+            except ValueError:
+                pass  # already ran
+        self._wakeup.set()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if self.server.refuse > 0:
+            self.server.refuse -= 1
+            return
+        self.server.connections += 1
+        self.wfile.write(b'220 fake\r\n')
+        while True:
+            line = self.rfile.readline()
+            cmd = line[:4].upper()
+            if not line:
+                return
+            elif cmd == b'EHLO':
+                self.wfile.write(b'250-fake\r\n250 AUTH PLAIN\r\n')
+            elif cmd == b'AUTH':
+                self.wfile.write(b'235 ok\r\n')
+            elif cmd == b'DATA':
+                self.wfile.write(b'354 go\r\n')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                self.server.mails.append(b''.join(data).decode())
+                self.wfile.write(b'250 ok\r\n')
+                if self.server.drop:
+                    return
+            elif cmd == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+def start_fake_smtp():
+    server = socketserver.ThreadingTCPServer(
+        ('127.0.0.1', 0), FakeSMTPHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.mails = []
+    server.drop = False
+    server.refuse = 0
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+class TestMsgSender(unittest.TestCase):
+    def setUp(self):
+        self.server = start_fake_smtp()
+        self.sender = MsgSender('me@localhost', 'pw', '127.0.0.1',
+                                self.server.server_address[1], tls=False)
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for i in range(3):
+            self.sender.send('them@localhost', 'subject', str(i))
+        self.assertEqual(3, len(self.server.mails))
+        self.assertEqual(1, self.server.connections)
+
+    def test_reconnect(self):
+        self.server.drop = True
+        for i in range(3):
+            self.sender.send('them@localhost', 'subject', str(i))
+        self.assertEqual(3, len(self.server.mails))
+        self.assertEqual(3, self.server.connections)
+
+    def test_digest(self):
+        queue = MsgQueue(self.sender, window=0.2)
+        queue.put('them@localhost', 'SS OK', 'first')
+        queue.put('them@localhost', 'SS ERROR!!!', 'second')
+        queue.put('them@localhost', 'SS OK', 'third')
+        time.sleep(0.5)
+        self.assertEqual(1, len(self.server.mails))
+        mail = self.server.mails[0]
+        self.assertIn('[3 messages] SS OK / SS ERROR!!!', mail)
+        for x in ('first', 'second', 'third'):
+            self.assertIn(x, mail)
+        queue.put('them@localhost', 'SS OK', 'fourth')
+        queue.close()
+        self.assertEqual(2, len(self.server.mails))
+        self.assertEqual(1, self.server.connections)
+
+    def test_retry(self):
+        queue = MsgQueue(self.sender, window=0)
+        queue.retry_delay = 0.1
+        self.server.refuse = 2
+        queue.put('them@localhost', 'SS ERROR!!!', 'down')
+        time.sleep(0.05)
+        self.assertEqual(1, queue.pending())
+        queue.put('them@localhost', 'SS OK', 'up')
+        # fails again after 0.1s, then sends both after 0.2s more
+        time.sleep(0.6)
+        self.assertEqual(0, queue.pending())
+        self.assertEqual(1, len(self.server.mails))
+        self.assertIn('[2 messages] SS ERROR!!! / SS OK',
+                      self.server.mails[0])
+        queue.close()
+
+    def test_close_keeps_unsent(self):
+        queue = MsgQueue(self.sender, window=60)
+        queue.put('them@localhost', 'SS ERROR!!!', 'down')
+        self.server.refuse = 1
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            queue.close()
+        self.assertEqual(1, queue.pending())
+        queue.flush()
+        self.assertEqual(0, queue.pending())
+        self.assertIn('SS ERROR!!!', self.server.mails[0])
+
+
+class SleepCollector(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def do(self):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return 'subject', 'msg'
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.server = start_fake_smtp()
+        self.config = tempfile.NamedTemporaryFile('w', suffix='.json')
+        json.dump({
+            'ME_ACCOUNT': 'me@localhost',
+            'ME_PASSWORD': 'pw',
+            'ME_SERVER': '127.0.0.1',
+            'ME_PORT': self.server.server_address[1],
+            'ME_TLS': False,
+            'THEM_ACCOUNT': 'them@localhost'
+        }, self.config)
+        self.config.flush()
+
+    def tearDown(self):
+        self.config.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def watch(self, jobs, duration=0.5, **kwargs):
+        watcher = Watcher(None, None, self.config.name)
+        for collector, interval, overrun in jobs:
+            watcher.add(collector, interval, overrun, **kwargs)
+        threading.Timer(duration, watcher.stop).start()
+        watcher.run()
+
+    def messages(self):
+        '''
+        count messages, a digest mail holds several
+        '''
+        ret = 0
+        for mail in self.server.mails:
+            m = re.search(r'\[(\d+) messages\]', mail)
+            ret += int(m.group(1)) if m else 1
+        return ret
+
+    def test_slow_collector(self):
+        fast = SleepCollector(0)
+        slow = SleepCollector(0.4)
+        self.watch([(fast, 0.05, 'skip'), (slow, 0.05, 'skip')])
+        self.assertGreaterEqual(fast.calls, 8)
+        self.assertLessEqual(slow.calls, 2)
+        self.assertEqual(fast.calls + slow.calls, self.messages())
+
+    def test_overrun(self):
+        skip = SleepCollector(0.12)
+        queue = SleepCollector(0.12)
+        parallel = SleepCollector(0.12)
+        self.watch([(skip, 0.05, 'skip'), (queue, 0.05, 'queue'),
+                    (parallel, 0.05, 'parallel')])
+        self.assertEqual(1, skip.max_active)
+        self.assertEqual(1, queue.max_active)
+        self.assertGreater(parallel.max_active, 1)
+        self.assertGreaterEqual(queue.calls, skip.calls)
+        self.assertGreater(parallel.calls, skip.calls)
+
+    def test_incremental(self):
+        states = [{'s': 'OK'}] * 3 + [{'s': 'ERROR'}] + [{'s': 'ERROR'}] * 100
+        collector = StateCollector(states)
+        self.watch([(collector, 0.05, 'skip')], duration=0.4,
+                   incremental=True)
+        self.assertEqual(2, len(self.server.mails))
+        self.assertIn('s: OK -> ERROR', self.server.mails[1])
+
+    def test_stop_long_interval(self):
+        collector = SleepCollector(0)
+        start = time.monotonic()
+        self.watch([(collector, 60, 'skip')], duration=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(1, collector.calls)
+
+
+class StateCollector(object):
+    def __init__(self, states):
+        self.states = iter(states)
+
+    def state(self):
+        return next(self.states)
+
+
+class TestWatchJob(unittest.TestCase):
+    def test_diff(self):
+        old = {'a': {'status': 'OK', 'urls': {'x': True}}, 'b': 1}
+        new = {'a': {'status': 'ERROR', 'urls': {'x': True}}, 'c': 2}
+        self.assertEqual({
+            ('a', 'status'): ('OK', 'ERROR'),
+            ('b',): (1, None),
+            ('c',): (None, 2)
+        }, diff(old, new))
+        self.assertEqual({}, diff(old, old))
+
+    def test_transitions(self):
+        job = WatchJob(None, 1, 'skip', incremental=True, heartbeat=10)
+        self.assertEqual('INITIAL STATE', job.update({'s': 'OK'}, 0)[0])
+        self.assertIsNone(job.update({'s': 'OK'}, 1))
+        self.assertEqual(('CHANGED: s: OK -> ERROR', 's: OK -> ERROR'),
+                         job.update({'s': 'ERROR'}, 2))
+        self.assertIsNone(job.update({'s': 'ERROR'}, 11))
+        self.assertEqual('HEARTBEAT', job.update({'s': 'ERROR'}, 12)[0])
+        self.assertEqual('CHANGED: s: ERROR -> OK',
+                         job.update({'s': 'OK'}, 13)[0])
+
+    def test_flapping(self):
+        job = WatchJob(None, 1, 'skip', incremental=True,
+                       flap_window=10, flap_count=3)
+        job.update({'s': 'OK'}, 0)
+        self.assertNotIn('FLAPPING', job.update({'s': 'ERROR'}, 1)[0])
+        self.assertNotIn('FLAPPING', job.update({'s': 'OK'}, 2)[0])
+        self.assertIn('FLAPPING', job.update({'s': 'ERROR'}, 3)[0])
+        self.assertNotIn('FLAPPING', job.update({'s': 'OK'}, 30)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()